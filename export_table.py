@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""Stream images_analytical out of ClickHouse in keyset-paginated pages.
+
+Replaces the `SELECT * ... LIMIT 1000000` + rename/recreate routine in
+nullify_table.sql for backfills and schema changes. Rows are read in
+(site_name_id, upload_date, image_id) order, one page at a time, as ClickHouse
+Native (binary) blocks over HTTP, and either:
+
+  - written to files:   --out DIR           (one .native file per page)
+  - piped into a table: --target TABLE      (INSERT ... SELECT ... FROM input(...) FORMAT Native)
+
+Pages are bounded by key, not OFFSET: each page first looks up its last key
+(`LIMIT 1 OFFSET page_size-1` on the sorting key) and then reads
+`key > previous_last AND key <= last`, so no page rescans earlier rows and a
+page can be retried on its own. Each tuple bound is paired with a plain
+upload_date bound, because ClickHouse only prunes primary-key granules on the
+latter; `EXPLAIN indexes = 1 SELECT ...` on a page query should show only that
+page's granules selected. Bytes are streamed from the source response to
+the file or target request in STREAM_CHUNK_SIZE pieces, so memory stays bounded
+whatever the page size. Key ranges are split by site_name_id and processed by
+--workers threads in parallel.
+
+Usage:
+  # Copy into a table created with the new schema; columns are matched by name
+  python export_table.py --target images_analytical_new --workers 4
+
+  # Transform on the way in (expressions over the source columns, in target column order)
+  python export_table.py --target images_analytical_new \\
+      --target-columns image_id,site_name_id,upload_date,caption \\
+      --select "image_id, site_name_id, toDate(upload_date), lower(caption)"
+
+  # Dump to Native files
+  python export_table.py --out export_dir --page-size 500000
+
+The target table must already exist. Progress per site_name_id is saved to
+--checkpoint so an interrupted run resumes after the last completed page
+(with --out, file numbering continues from the last written page).
+"""
+
+import json
+import os
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import myPasswords
+
+CLICKHOUSE_CONFIG = myPasswords.clickhouse
+
+PAGE_SIZE = 1000000
+STREAM_CHUNK_SIZE = 1 << 20
+KEY_COLUMNS = ('site_name_id', 'upload_date', 'image_id')
+HTTP_TIMEOUT = 3600
+
+
+class ClickHouseHTTP:
+    """Minimal ClickHouse HTTP client (stdlib only) that can stream request and response bodies."""
+
+    def __init__(self, conf, port):
+        host = conf.get('host', '127.0.0.1')
+        if host == 'localhost':
+            host = '127.0.0.1'
+        self.base_url = f"http://{host}:{port}/"
+        self.username = conf.get('username')
+        self.password = conf.get('password')
+        self.database = conf.get('database')
+
+    def _request(self, query, data=None):
+        params = {'query': query}
+        if self.database:
+            params['database'] = self.database
+        req = urllib.request.Request(self.base_url + '?' + urllib.parse.urlencode(params), data=data, method='POST')
+        if self.username is not None:
+            req.add_header('X-ClickHouse-User', self.username)
+        if self.password is not None:
+            req.add_header('X-ClickHouse-Key', self.password)
+        try:
+            return urllib.request.urlopen(req, timeout=HTTP_TIMEOUT)
+        except urllib.error.HTTPError as e:
+            body = e.read(2000).decode(errors='replace')
+            raise Exception(f"ClickHouse HTTP {e.code}: {body.strip()}") from None
+
+    def query_rows(self, query):
+        """Run a small query and return its TabSeparated rows as lists of strings."""
+        with self._request(query + ' FORMAT TabSeparated') as resp:
+            text = resp.read().decode()
+        return [line.split('\t') for line in text.splitlines() if line]
+
+    def stream(self, query):
+        """Open a streaming response; the caller reads and closes it."""
+        return self._request(query)
+
+    def insert_stream(self, query, chunks):
+        """POST an iterable of byte chunks (sent with chunked transfer encoding)."""
+        with self._request(query, data=chunks) as resp:
+            resp.read()
+
+
+def _sql_literal(value):
+    return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def _iter_chunks(resp, counter):
+    while True:
+        chunk = resp.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        counter[0] += len(chunk)
+        yield chunk
+
+
+class Exporter:
+    def __init__(self, source, target_client, args):
+        self.source = source
+        self.target_client = target_client
+        self.args = args
+        self.source_table = args.source
+        self.final = ' FINAL' if args.final else ''
+        self.checkpoint = {}
+        self.lock = threading.Lock()
+        if args.checkpoint and os.path.exists(args.checkpoint):
+            with open(args.checkpoint) as f:
+                self.checkpoint = json.load(f)
+            print(f"Resuming from checkpoint {args.checkpoint} ({len(self.checkpoint)} site(s) in progress or done)")
+
+        structure = self.source.query_rows(f"DESCRIBE TABLE {self.source_table}")
+        self.source_columns = [(row[0], row[1]) for row in structure]
+        self.insert_query = self._build_insert_query() if args.target else None
+
+    def _build_insert_query(self):
+        structure = ', '.join(f"{name} {type_}" for name, type_ in self.source_columns)
+        if self.args.select:
+            select = self.args.select
+            target_columns = self.args.target_columns
+        else:
+            # Copy columns present in both tables by name; new target columns get their defaults
+            target = {row[0] for row in self.target_client.query_rows(f"DESCRIBE TABLE {self.args.target}")}
+            common = [name for name, _ in self.source_columns if name in target]
+            select = ', '.join(common)
+            target_columns = ','.join(common)
+        columns = f" ({target_columns})" if target_columns else ''
+        return (f"INSERT INTO {self.args.target}{columns} SELECT {select} "
+                f"FROM input({_sql_literal(structure)}) FORMAT Native")
+
+    def _save_checkpoint(self, site_name_id, last_key, pages, done=False):
+        if not self.args.checkpoint:
+            return
+        with self.lock:
+            self.checkpoint[str(site_name_id)] = {'last_key': last_key, 'pages': pages, 'done': done}
+            tmp = self.args.checkpoint + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.checkpoint, f, indent=2)
+            os.replace(tmp, self.args.checkpoint)
+
+    def _page_end(self, where):
+        """Return (upload_date, image_id) of the last row of the next page, or None if fewer rows remain."""
+        rows = self.source.query_rows(
+            f"SELECT toString(upload_date), image_id FROM {self.source_table}{self.final} WHERE {where} "
+            f"ORDER BY upload_date, image_id LIMIT 1 OFFSET {self.args.page_size - 1}"
+        )
+        return (rows[0][0], int(rows[0][1])) if rows else None
+
+    def export_site(self, site_name_id):
+        state = self.checkpoint.get(str(site_name_id), {})
+        if state.get('done'):
+            return site_name_id, 0, 0
+        last = state.get('last_key')
+        # Continue the page numbering so a resumed --out run doesn't overwrite earlier files
+        first_page = state.get('pages', 0)
+        pages = first_page
+        total_bytes = 0
+        while True:
+            # The primary index can't prune on tuple comparisons, so each tuple bound is
+            # paired with a plain upload_date bound that it can use
+            where = f"site_name_id = {site_name_id}"
+            if last is not None:
+                where += (f" AND upload_date >= toDateTime({_sql_literal(last[0])})"
+                          f" AND (upload_date, image_id) > (toDateTime({_sql_literal(last[0])}), {last[1]})")
+            end = self._page_end(where)
+            page_where = where
+            if end is not None:
+                page_where += (f" AND upload_date <= toDateTime({_sql_literal(end[0])})"
+                               f" AND (upload_date, image_id) <= (toDateTime({_sql_literal(end[0])}), {end[1]})")
+
+            query = (f"SELECT * FROM {self.source_table}{self.final} WHERE {page_where} "
+                     f"ORDER BY {', '.join(KEY_COLUMNS)} FORMAT Native")
+            counter = [0]
+            with self.source.stream(query) as resp:
+                if self.args.target:
+                    self.target_client.insert_stream(self.insert_query, _iter_chunks(resp, counter))
+                else:
+                    path = os.path.join(self.args.out, f"{site_name_id}_{pages:06d}.native")
+                    with open(path, 'wb') as f:
+                        for chunk in _iter_chunks(resp, counter):
+                            f.write(chunk)
+            pages += 1
+            total_bytes += counter[0]
+            print(f"  site_name_id={site_name_id} page {pages}: {counter[0] / 1e6:.1f} MB"
+                  f"{' (last page)' if end is None else f' up to {end}'}")
+
+            if end is None:
+                self._save_checkpoint(site_name_id, last, pages, done=True)
+                return site_name_id, pages - first_page, total_bytes
+            last = list(end)
+            self._save_checkpoint(site_name_id, last, pages)
+
+    def run(self):
+        sites = [int(row[0]) for row in self.source.query_rows(
+            f"SELECT DISTINCT site_name_id FROM {self.source_table} ORDER BY site_name_id")]
+        print(f"Exporting {self.source_table} ({len(sites)} site_name_id ranges, {self.args.workers} workers, "
+              f"{self.args.page_size} rows/page)")
+        if self.insert_query:
+            print(f"Target insert: {self.insert_query[:200]}...")
+
+        grand_total = 0
+        with ThreadPoolExecutor(max_workers=self.args.workers) as pool:
+            futures = {pool.submit(self.export_site, s): s for s in sites}
+            for future in as_completed(futures):
+                site_name_id, pages, total_bytes = future.result()
+                grand_total += total_bytes
+                print(f"✓ site_name_id={site_name_id}: {pages} page(s), {total_bytes / 1e6:.1f} MB")
+        print(f"Done: {grand_total / 1e6:.1f} MB streamed")
+
+
+def default_http_port():
+    try:
+        port = int(CLICKHOUSE_CONFIG.get('port', 0))
+    except Exception:
+        port = 0
+    return port if port in (8123, 18123) else 8123
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Keyset-paginated streaming export/rebuild of images_analytical')
+    parser.add_argument('--source', default='images_analytical', help='Source table')
+    dest = parser.add_mutually_exclusive_group(required=True)
+    dest.add_argument('--target', help='Existing table to stream pages into')
+    dest.add_argument('--out', help='Directory to write one Native file per page')
+    parser.add_argument('--select', default=None, help='SELECT expressions over the source columns (default: columns shared by name)')
+    parser.add_argument('--target-columns', default=None, help='Comma-separated target columns matching --select')
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE, help='Rows per page')
+    parser.add_argument('--workers', type=int, default=4, help='Parallel site_name_id ranges')
+    parser.add_argument('--final', action='store_true', help='Read the source with FINAL (deduplicated, slower)')
+    parser.add_argument('--port', type=int, default=None, help='ClickHouse HTTP port (default: configured port if HTTP, else 8123)')
+    parser.add_argument('--target-host', default=None, help='Send --target inserts to another ClickHouse host (same credentials)')
+    parser.add_argument('--checkpoint', default=None, help='JSON file recording the last exported key per site_name_id')
+    args = parser.parse_args()
+
+    if args.select and args.target is None:
+        parser.error('--select requires --target')
+
+    port = args.port or default_http_port()
+    source = ClickHouseHTTP(CLICKHOUSE_CONFIG, port)
+    target_client = source
+    if args.target_host:
+        target_client = ClickHouseHTTP(dict(CLICKHOUSE_CONFIG, host=args.target_host), port)
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+
+    Exporter(source, target_client, args).run()
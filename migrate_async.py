@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""Single-process asyncio variant of migrate_data.migrate_range.
+
+The migrator spends most of its time waiting on MySQL queries and ClickHouse
+inserts, so instead of one process per range this keeps many range queries and
+many insert streams in flight from one event loop:
+
+  - image_id ranges of --range-size rows are extracted through an aiomysql pool
+    of --mysql-concurrency connections
+  - each range is transformed with migrate_data.transform_row and inserted in
+    INSERT_CHUNK_SIZE chunks over the ClickHouse HTTP interface with aiohttp,
+    at most --insert-concurrency chunks at a time; transforming and encoding
+    run in worker threads (asyncio.to_thread) so they don't stall the loop
+  - at most mysql + insert concurrency ranges are held in memory at once, so a
+    fast MySQL side cannot run ahead of a slow ClickHouse link
+
+Ranges finish out of order, so max(image_id) in ClickHouse is not a safe resume
+point. Completed ranges are recorded in --checkpoint instead and skipped on the
+next run; re-inserting a partially loaded range is harmless for
+images_analytical (ReplacingMergeTree).
+
+For the same reason, --rollups does not count per range, since the rollups'
+progress marks (see migrate_rollups) assume in-order loading. Once every range
+has succeeded, migrate_data.catch_up_rollups counts the loaded rows from each
+mark up to --end on the server. Retried ranges and later migrate_data.py
+--rollups runs therefore never count a row twice.
+
+Requires: pip install aiomysql aiohttp
+
+Usage:
+  python migrate_async.py --start 1 --end 5000000 --mysql-concurrency 8 --insert-concurrency 8
+"""
+
+import asyncio
+import json
+import os
+import time
+
+import migrate_data
+from migrate_data import (
+    ARRAY_SIZE, CLICKHOUSE_CONFIG, EXTRACT_QUERY, INSERT_CHUNK_SIZE, INSERT_COLUMNS, LANDMARK_FLAG_COLUMNS,
+    MYSQL_CONFIG, encode_insert, load_transport_config, table_types, transform_row,
+)
+
+RANGE_SIZE = 50000
+INSERT_RETRIES = 3
+INSERT_TIMEOUT = 600
+CHECKPOINT_FILE = 'migrate_async_checkpoint.json'
+
+
+def load_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {tuple(r) for r in json.load(f).get('completed', [])}
+
+
+def save_checkpoint(path, completed):
+    if not path:
+        return
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'completed': sorted(completed)}, f)
+    os.replace(tmp, path)
+
+
+class AsyncMigrator:
+    def __init__(self, pool, session, args, transport=None, presence=None, dictionary=False):
+        self.pool = pool
+        self.session = session
+        self.args = args
+        self.presence = presence
+        self.dictionary = dictionary
+        # table name -> column types, needed for dictionary encoding (filled in run())
+        self.types = {}
+        self.insert_sem = asyncio.Semaphore(args.insert_concurrency)
+        # Bounds how many extracted ranges are held in memory at once
+        self.inflight_sem = asyncio.Semaphore(args.mysql_concurrency + args.insert_concurrency)
+        self.completed = load_checkpoint(args.checkpoint)
+        self.failed = []
+        self.rows_done = 0
+        self.started = time.time()
+
+        host = CLICKHOUSE_CONFIG.get('host', '127.0.0.1')
+        if host == 'localhost':
+            host = '127.0.0.1'
+        port = args.http_port
+        self.format = 'JSONEachRow'
+        self.compression = None
+        if transport and transport['transport'] == 'http':
+            port = port or transport.get('port')
+            self.compression = transport.get('compression')
+        if transport:
+            self.format = transport['format']
+        if not port:
+            configured = int(CLICKHOUSE_CONFIG.get('port', 0) or 0)
+            port = configured if configured in (8123, 18123) else 8123
+        self.url = f"http://{host}:{port}/"
+        self.database = CLICKHOUSE_CONFIG.get('database')
+
+    async def fetch_array_map(self, conn, table_name, id_column, image_ids):
+        """Async counterpart of migrate_data.fetch_array_map"""
+        res = {}
+        async with conn.cursor() as cursor:
+            for i in range(0, len(image_ids), ARRAY_SIZE):
+                chunk = image_ids[i:i + ARRAY_SIZE]
+                q = f"SELECT image_id, {id_column} FROM {table_name} WHERE image_id IN ({','.join(['%s'] * len(chunk))})"
+                await cursor.execute(q, tuple(chunk))
+                for image_id, val in await cursor.fetchall():
+                    res.setdefault(image_id, []).append(val)
+        return res
+
+    async def extract(self, start_id, end_id):
+        import aiomysql
+
+        async with self.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute(EXTRACT_QUERY, (start_id, end_id))
+                mysql_rows = await cursor.fetchall()
+            image_ids = [r['image_id'] for r in mysql_rows]
+            keywords_dict = await self.fetch_array_map(conn, 'ImagesKeywords', 'keyword_id', image_ids)
+            ethnicity_dict = await self.fetch_array_map(conn, 'ImagesEthnicity', 'ethnicity_id', image_ids)
+        return mysql_rows, keywords_dict, ethnicity_dict
+
+    def encode_chunk(self, table_name, columns, rows):
+        """Return (query, request body bytes); CPU-bound, so insert_chunk runs it in a worker thread"""
+        query, payload = encode_insert(table_name, rows, self.format, columns, self.dictionary, self.types.get(table_name))
+        data = payload.encode()
+        if self.compression == 'gzip':
+            import gzip
+            data = gzip.compress(data, compresslevel=1)
+        return query, data
+
+    async def insert_chunk(self, table, columns, rows):
+        import aiohttp
+
+        table_name = f"{self.database}.{table}" if self.database else table
+        query, data = await asyncio.to_thread(self.encode_chunk, table_name, columns, rows)
+        headers = {}
+        if self.compression == 'gzip':
+            headers['Content-Encoding'] = 'gzip'
+        params = {'query': query}
+        if self.database:
+            params['database'] = self.database
+        auth = None
+        if CLICKHOUSE_CONFIG.get('username') is not None:
+            auth = aiohttp.BasicAuth(CLICKHOUSE_CONFIG['username'], CLICKHOUSE_CONFIG.get('password') or '')
+
+        async with self.insert_sem:
+            for attempt in range(1, INSERT_RETRIES + 1):
+                try:
+                    async with self.session.post(self.url, params=params, data=data, headers=headers, auth=auth) as resp:
+                        body = await resp.text()
+                        if resp.status == 200 and not body.strip().startswith('Code:'):
+                            return
+                        error = f"HTTP {resp.status}: {body.strip()[:500]}"
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = repr(e)
+                print(f"  ✗ Insert into {table} failed (attempt {attempt}/{INSERT_RETRIES}): {error}")
+                if attempt < INSERT_RETRIES:
+                    await asyncio.sleep(2 ** attempt)
+        raise Exception(f"ClickHouse insert error: {error}")
+
+    async def insert_rows(self, rows, table='images_analytical', columns=None):
+        if not rows:
+            return
+        if columns is None:
+            columns = INSERT_COLUMNS + [c for c in LANDMARK_FLAG_COLUMNS if c in rows[0]]
+        await asyncio.gather(*[
+            self.insert_chunk(table, columns, rows[i:i + INSERT_CHUNK_SIZE])
+            for i in range(0, len(rows), INSERT_CHUNK_SIZE)
+        ])
+
+    async def migrate_one(self, start_id, end_id):
+        async with self.inflight_sem:
+            try:
+                t0 = time.time()
+                mysql_rows, keywords_dict, ethnicity_dict = await self.extract(start_id, end_id)
+                t1 = time.time()
+                # CPU-bound: run off the event loop so in-flight MySQL reads and uploads keep moving
+                transformed_rows = await asyncio.to_thread(
+                    lambda: [transform_row(row, keywords_dict, ethnicity_dict, self.presence) for row in mysql_rows])
+                del mysql_rows
+                await self.insert_rows(transformed_rows)
+                t2 = time.time()
+            except Exception as e:
+                print(f"✗ Range {start_id} to {end_id} failed: {e}")
+                self.failed.append((start_id, end_id))
+                return
+
+            self.completed.add((start_id, end_id))
+            save_checkpoint(self.args.checkpoint, self.completed)
+            self.rows_done += len(transformed_rows)
+            rate = self.rows_done / max(time.time() - self.started, 1e-9)
+            print(f"Migrated {start_id} to {end_id}: {len(transformed_rows)} rows "
+                  f"(MySQL {t1 - t0:.2f}s, transform+insert {t2 - t1:.2f}s, overall {rate:.0f} rows/s)")
+
+    async def run(self, start_id, end_id):
+        ranges = [(s, min(s + self.args.range_size, end_id)) for s in range(start_id, end_id, self.args.range_size)]
+        todo = [r for r in ranges if r not in self.completed]
+        if self.dictionary:
+            table_name = f"{self.database}.images_analytical" if self.database else 'images_analytical'
+            self.types[table_name] = await asyncio.to_thread(table_types, table_name)
+
+        print(f"Migrating {start_id} to {end_id}: {len(todo)} of {len(ranges)} range(s) to do, "
+              f"MySQL concurrency {self.args.mysql_concurrency}, insert concurrency {self.args.insert_concurrency}")
+        await asyncio.gather(*[self.migrate_one(s, e) for s, e in todo])
+
+        if self.failed:
+            print(f"\n✗ {len(self.failed)} range(s) failed; re-run to retry them (completed ranges are skipped):")
+            for s, e in sorted(self.failed):
+                print(f"  --start {s} --end {e}")
+        else:
+            print(f"\n✓ Done: {self.rows_done} rows in {time.time() - self.started:.1f}s")
+
+
+async def migrate_range_async(start_id, end_id, args, transport=None, presence=None, dictionary=False):
+    """Migrate [start_id, end_id) with concurrent MySQL queries and ClickHouse inserts"""
+    import aiohttp
+    import aiomysql
+
+    pool = await aiomysql.create_pool(
+        host=MYSQL_CONFIG.get('host', '127.0.0.1'),
+        port=int(MYSQL_CONFIG.get('port', 3306)),
+        user=MYSQL_CONFIG.get('user'),
+        password=MYSQL_CONFIG.get('password', ''),
+        db=MYSQL_CONFIG.get('database'),
+        minsize=1,
+        maxsize=args.mysql_concurrency,
+        autocommit=True,
+    )
+    connector = aiohttp.TCPConnector(limit=args.insert_concurrency)
+    timeout = aiohttp.ClientTimeout(total=INSERT_TIMEOUT)
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            migrator = AsyncMigrator(pool, session, args, transport, presence, dictionary)
+            await migrator.run(start_id, end_id)
+            return not migrator.failed
+    finally:
+        pool.close()
+        await pool.wait_closed()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    import mysql.connector
+
+    parser = argparse.ArgumentParser(description='Migrate images from MySQL to ClickHouse with asyncio')
+    parser.add_argument('--start', type=int, default=None, help='Start image_id (inclusive)')
+    parser.add_argument('--end', type=int, default=None, help='End image_id (exclusive)')
+    parser.add_argument('--range-size', type=int, default=RANGE_SIZE, help='image_ids per MySQL range query')
+    parser.add_argument('--mysql-concurrency', type=int, default=4, help='Concurrent MySQL range queries (pool size)')
+    parser.add_argument('--insert-concurrency', type=int, default=4, help='Concurrent ClickHouse insert requests')
+    parser.add_argument('--http-port', type=int, default=None, help='ClickHouse HTTP port (default: probed transport, configured HTTP port, or 8123)')
+    parser.add_argument('--checkpoint', default=CHECKPOINT_FILE, help='File recording completed ranges (empty string to disable)')
+    parser.add_argument('--wire-dict', action='store_true', help='Dictionary/prefix-encode repetitive string columns on the wire')
+    parser.add_argument('--presence-bitmaps', default=None, help='Directory of MongoDB presence bitmaps built by presence_bitmaps.py')
+    parser.add_argument('--rollups', action='store_true', help='Count the loaded rows into the rollup tables once every range has succeeded')
+    args = parser.parse_args()
+
+    start, end = args.start, args.end
+    if start is None or end is None:
+        mysql_conn = mysql.connector.connect(**MYSQL_CONFIG)
+        cursor = mysql_conn.cursor()
+        cursor.execute("SELECT MIN(image_id), MAX(image_id) FROM Images")
+        min_id, max_id = cursor.fetchone()
+        mysql_conn.close()
+        start = start if start is not None else min_id
+        # --end is exclusive; include the last image when it comes from MAX(image_id)
+        end = end if end is not None else (max_id + 1 if max_id is not None else None)
+
+    if start is None or end is None:
+        print("Could not determine image ID range from database and no --start/--end provided")
+        raise SystemExit(1)
+
+    transport = load_transport_config()
+    # The rollup DDL helpers in migrate_data read its TRANSPORT global
+    migrate_data.TRANSPORT = transport
+    dictionary = args.wire_dict or bool(transport and transport.get('dictionary'))
+
+    presence = None
+    if args.presence_bitmaps:
+        from presence_bitmaps import PresenceIndex
+
+        presence = PresenceIndex(args.presence_bitmaps)
+        print(f"Loaded presence bitmaps from {args.presence_bitmaps}: {', '.join(presence.flags)}")
+
+    if args.rollups:
+        migrate_data.create_rollup_tables()
+
+    ok = asyncio.run(migrate_range_async(start, end, args, transport, presence, dictionary))
+    if args.rollups:
+        if ok:
+            # Count everything loaded below `end` once, server-side, and move the progress marks
+            migrate_data.catch_up_rollups(end)
+        else:
+            print("Rollups not updated: re-run until every range succeeds (or use migrate_data.py --rebuild-rollups)")
+    raise SystemExit(0 if ok else 1)
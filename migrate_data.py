@@ -2,7 +2,10 @@
 import mysql.connector
 import subprocess
 import json
-import types
+import gzip
+import os
+import urllib.parse
+from contextlib import nullcontext
 from datetime import datetime
 import time
     
@@ -28,15 +31,13 @@ CLICKHOUSE_CONFIG = myPasswords.clickhouse
 # }
 
 BATCH_SIZE = 1000000
+# --profile runs smaller batches: tracemalloc slows everything while a whole batch is live
+PROFILE_BATCH_SIZE = 100000
 ARRAY_SIZE = 10000
 INSERT_CHUNK_SIZE = 10000
 
-def extract_batch(mysql_conn, start_id, end_id):
-    """Extract and transform a batch of images"""
-    cursor = mysql_conn.cursor(dictionary=True)
-    
-    # Main query (use the comprehensive query from above)
-    query = """
+# Main extract query, parameterised by (start_id, end_id); shared with migrate_async.py
+EXTRACT_QUERY = """
     SELECT 
         -- Core image metadata
         i.image_id,
@@ -160,8 +161,13 @@ def extract_batch(mysql_conn, start_id, end_id):
     WHERE i.image_id >= %s AND i.image_id < %s
     ORDER BY i.image_id;
         """
+
+
+def extract_batch(mysql_conn, start_id, end_id):
+    """Extract and transform a batch of images"""
+    cursor = mysql_conn.cursor(dictionary=True)
     
-    cursor.execute(query, (start_id, end_id))
+    cursor.execute(EXTRACT_QUERY, (start_id, end_id))
     return cursor.fetchall()
 
 def fetch_array_map(mysql_conn, table_name, id_column, image_ids):
@@ -257,8 +263,12 @@ def get_clickhouse_max_image_id():
     return None
 
 
-def transform_row(row, keywords_dict, ethnicity_dict):
-    """Transform MySQL row to ClickHouse JSON row format"""
+def transform_row(row, keywords_dict, ethnicity_dict, presence=None):
+    """Transform MySQL row to ClickHouse JSON row format
+
+    presence is an optional presence_bitmaps.PresenceIndex; its MongoDB landmark
+    flags are looked up per image_id and added to (or OR-ed into) the row.
+    """
     image_id = row['image_id']
 
     keyword_ids = keywords_dict.get(image_id, []) if keywords_dict is not None else []
@@ -356,94 +366,362 @@ def transform_row(row, keywords_dict, ethnicity_dict):
         'updated_at': format_date_for_ch(row.get('updated_at')),
     }
 
+    if presence is not None:
+        for flag, value in presence.lookup(image_id).items():
+            if flag in ('has_left_hand', 'has_right_hand'):
+                transformed[flag] = 1 if (transformed[flag] or value) else 0
+            else:
+                transformed[flag] = value
+        transformed['has_hands'] = 1 if (transformed['has_left_hand'] or transformed['has_right_hand']) else 0
+
     return transformed
 
-def insert_batch(rows):
+# Column list must match the JSON object keys and the table schema
+INSERT_COLUMNS = [
+    'image_id','site_name_id','site_name','site_image_id','gender_id','gender','age_id','age','age_detail_id','location_id','country_code','region',
+    'keyword_ids','ethnicity_ids','ethnicity_white','ethnicity_black','ethnicity_asian','ethnicity_hispanic','ethnicity_middle_eastern','ethnicity_native_american','ethnicity_pacific_islander','ethnicity_mixed','ethnicity_other',
+    'has_face','has_body','has_feet','has_hands','has_left_hand','has_right_hand','is_face_distant','is_small','is_face_no_lms',
+    'face_x','face_y','face_z','mouth_gap',
+    'body_pose_cluster_256','body_pose_cluster_512','body_pose_cluster_768','hand_poses_cluster_32','hand_gesture_cluster_32','hand_gesture_cluster_64','hand_gesture_cluster_128','arms_poses3D_cluster_64','arm_poses3D_cluster_128','hand_position_cluster_128','hsv_cluster','meta_hsv_cluster','face_cluster',
+    'is_not_face_topic_id','is_not_face_score','is_face_model_topic_id','is_face_model_score','affect_id','affect_score','obj_cluster',
+    'topic_id_1','topic_score_1','topic_id_2','topic_score_2','topic_id_3','topic_score_3',
+    'detection_count','detection_classes','detection_top_class_id','detection_top_class_confidence',
+    'upload_date','author','caption','content_url','width','height','is_dupe_of','updated_at'
+]
+
+# MongoDB landmark presence flags; only sent when the rows carry them (--presence-bitmaps)
+LANDMARK_FLAG_COLUMNS = [
+    'has_face_landmarks','has_body_landmarks','has_face_encodings','has_body_world_landmarks','has_body_landmarks_norm'
+]
+
+# Optional presence_bitmaps.PresenceIndex, loaded at startup from --presence-bitmaps
+PRESENCE = None
+
+# Maintain the migrate_rollups tables batch by batch (--rollups)
+ROLLUPS = False
+# rollup table -> counted_to mark (see migrate_rollups.PROGRESS_TABLE), loaded by catch_up_rollups
+ROLLUP_PROGRESS = {}
+
+# migrate_profiler.MigrationProfiler while running --profile; insert_batch calls
+# its checkpoint() once a chunk payload is built, so the payload shows up as live memory
+PROFILER = None
+
+# Wire formats the migrator can encode. JSONCompactEachRow drops the repeated
+# column names from every row, which matters on slow links.
+INSERT_FORMATS = ('JSONEachRow', 'JSONCompactEachRow')
+
+# Preferred insert path, written by `python test_connection.py --probe`.
+# Example: {"transport": "http", "port": 18123, "format": "JSONCompactEachRow", "compression": "gzip", "dictionary": true}
+# transport: native (clickhouse-client) | http (curl)
+# compression: none | lz4 (native) | gzip (http)
+# dictionary: dictionary/prefix-encode repetitive string columns (see encode_insert)
+TRANSPORT_CONFIG_FILE = os.environ.get('CLICKHOUSE_TRANSPORT_CONFIG', 'clickhouse_transport.json')
+TRANSPORT = None
+
+# Dictionary/prefix wire encoding (--wire-dict, or "dictionary" in the transport config).
+# Columns that repeat heavily within a chunk travel as 1-based ids into a per-chunk dictionary
+DICT_COLUMNS = ['site_name', 'gender', 'age', 'country_code', 'region', 'author', 'caption']
+# Columns sent as (prefix id, suffix); the prefix is everything up to the last '/'
+PREFIX_COLUMNS = ['content_url']
+# Only encode a column when its distinct values are at most this share of the chunk's rows
+DICT_MAX_RATIO = 0.5
+# The dictionaries travel in the query text, which is a single argv string for both
+# clickhouse-client (--query) and curl (URL-encoded in the URL). Linux caps one argv
+# string at 128 KiB (MAX_ARG_STRLEN) and ClickHouse caps query text at max_query_size
+# (256 KiB). Limit the whole URL-encoded query to this, leaving room for the URL prefix;
+# the largest dictionaries are dropped (sent as plain strings) until it fits.
+DICT_MAX_QUERY_BYTES = 96 * 1024
+WIRE_DICTIONARY = False
+
+
+def load_transport_config(path=TRANSPORT_CONFIG_FILE):
+    """Return the probed transport config from `path`, or None to keep the default fallback chain."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            conf = json.load(f)
+    except Exception as e:
+        print(f"Ignoring {path}: {e}")
+        return None
+
+    if conf.get('transport') not in ('native', 'http') or conf.get('format', 'JSONEachRow') not in INSERT_FORMATS:
+        print(f"Ignoring {path}: unsupported transport/format {conf}")
+        return None
+    conf.setdefault('format', 'JSONEachRow')
+    conf.setdefault('compression', None)
+    conf.setdefault('dictionary', False)
+    print(f"Using insert transport from {path}: {conf['transport']}:{conf.get('port')} "
+          f"format={conf['format']} compression={conf['compression']} dictionary={conf['dictionary']}")
+    return conf
+
+
+# No spaces after ',' and ':' in the wire JSON (saves ~1 byte per field per row)
+JSON_SEPARATORS = (',', ':')
+
+
+def encode_payload(rows, fmt='JSONEachRow', columns=INSERT_COLUMNS):
+    """Encode transformed rows for an INSERT ... FORMAT <fmt> query"""
+    if fmt == 'JSONCompactEachRow':
+        return '\n'.join([json.dumps([row.get(c) for c in columns], default=str, separators=JSON_SEPARATORS) for row in rows])
+    return '\n'.join([json.dumps(row, default=str, separators=JSON_SEPARATORS) for row in rows])
+
+
+def _ch_string(value):
+    """Quote a Python string as a ClickHouse string literal"""
+    escaped = (str(value).replace('\\', '\\\\').replace("'", "\\'")
+               .replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t').replace('\0', '\\0'))
+    return f"'{escaped}'"
+
+
+def _dictionary(values):
+    """Return (dictionary list, {value: 1-based id}) or None when values are too diverse to pay off"""
+    ids = {}
+    for v in values:
+        if v not in ids:
+            ids[v] = len(ids) + 1
+    if len(ids) > DICT_MAX_RATIO * len(values):
+        return None
+    return list(ids), ids
+
+
+def _split_prefix(value):
+    """Split a URL-like string into (prefix up to and including the last '/', suffix)"""
+    head, sep, tail = (value or '').rpartition('/')
+    return head + sep, tail
+
+
+def encode_insert(table_name, rows, fmt='JSONEachRow', columns=INSERT_COLUMNS, dictionary=False, types=None):
+    """Return (insert_query, payload) for one chunk of transformed rows.
+
+    With dictionary=True (and the table's column types, see table_types), each DICT_COLUMNS
+    column whose values repeat enough is sent as integer ids into a per-chunk dictionary
+    embedded in the query, and PREFIX_COLUMNS as a prefix id plus the remaining suffix.
+    ClickHouse rebuilds the strings in INSERT ... SELECT ... FROM input(...), so the stored
+    table is unchanged. Rows are sent as JSONCompactEachRow in that mode. The largest
+    dictionaries are dropped until the URL-encoded query fits DICT_MAX_QUERY_BYTES; with
+    none left the chunk is sent in the plain `fmt` encoding.
+    """
+    if not dictionary or not types or any(c not in types for c in columns):
+        query = f"INSERT INTO {table_name} ({', '.join(columns)}) FORMAT {fmt}"
+        return query, encode_payload(rows, fmt, columns)
+
+    # column -> (ClickHouse array literal, {value: id}); for PREFIX_COLUMNS the values are prefixes
+    dictionaries = {}
+    for c in columns:
+        if c in DICT_COLUMNS:
+            d = _dictionary([row.get(c) or '' for row in rows])
+        elif c in PREFIX_COLUMNS:
+            d = _dictionary([_split_prefix(row.get(c))[0] for row in rows])
+        else:
+            continue
+        if d is not None:
+            values, ids = d
+            dictionaries[c] = '[' + ','.join(_ch_string(v) for v in values) + ']', ids
+
+    query, encoders = _dictionary_insert(table_name, columns, types, dictionaries)
+    while dictionaries and len(urllib.parse.quote_plus(query)) > DICT_MAX_QUERY_BYTES:
+        del dictionaries[max(dictionaries, key=lambda c: len(dictionaries[c][0]))]
+        query, encoders = _dictionary_insert(table_name, columns, types, dictionaries)
+    if not dictionaries:
+        query = f"INSERT INTO {table_name} ({', '.join(columns)}) FORMAT {fmt}"
+        return query, encode_payload(rows, fmt, columns)
+
+    payload = '\n'.join([json.dumps([enc(row) for enc in encoders], default=str, separators=JSON_SEPARATORS) for row in rows])
+    return query, payload
+
+
+def _dictionary_insert(table_name, columns, types, dictionaries):
+    """Return (insert_query, per-input-column encoders) using the given column dictionaries"""
+    input_columns = []  # (name, type) sent on the wire
+    selects = []
+    encoders = []  # per input column: function(row) -> JSON value
+    for c in columns:
+        if c in dictionaries and c in PREFIX_COLUMNS:
+            literal, ids = dictionaries[c]
+            input_columns += [(f'{c}__p', 'UInt32'), (f'{c}__s', 'String')]
+            selects.append(f"concat(arrayElement({literal}, {c}__p), {c}__s) AS {c}")
+            encoders.append(lambda row, c=c, ids=ids: ids[_split_prefix(row.get(c))[0]])
+            encoders.append(lambda row, c=c: _split_prefix(row.get(c))[1])
+        elif c in dictionaries:
+            literal, ids = dictionaries[c]
+            input_columns.append((f'{c}__id', 'UInt32'))
+            selects.append(f"arrayElement({literal}, {c}__id) AS {c}")
+            encoders.append(lambda row, c=c, ids=ids: ids[row.get(c) or ''])
+        else:
+            input_columns.append((c, types[c]))
+            selects.append(c)
+            encoders.append(lambda row, c=c: row.get(c))
+
+    structure = ', '.join(f"{name} {type_}" for name, type_ in input_columns)
+    query = (f"INSERT INTO {table_name} ({', '.join(columns)}) SELECT {', '.join(selects)} "
+             f"FROM input({_ch_string(structure)}) FORMAT JSONCompactEachRow")
+    return query, encoders
+
+
+def _clickhouse_target(conf=None):
+    conf = CLICKHOUSE_CONFIG if conf is None else conf
+    host = conf.get('host', '127.0.0.1')
+    if host == 'localhost':
+        host = '127.0.0.1'
+    return host, conf.get('username'), conf.get('password'), conf.get('database')
+
+
+def run_client_query(port, query, payload=None, compression=None, conf=None, timeout=60):
+    """Run a query through clickhouse-client (native protocol), optionally piping payload to stdin.
+
+    Returns (ok, output, returncode).
+    """
+    host, username, password, database = _clickhouse_target(conf)
+    args = ['clickhouse-client', '--host', host, '--port', str(port), '--query', query]
+    if username is not None:
+        args += ['--user', username]
+    if password is not None:
+        args += ['--password', password]
+    if database is not None:
+        args += ['--database', database]
+    if compression is not None:
+        args += ['--compression', '0' if compression == 'none' else '1']
+
+    try:
+        r = subprocess.run(
+            args,
+            input=payload.encode() if payload is not None else None,
+            capture_output=True,
+            timeout=timeout
+        )
+    except FileNotFoundError:
+        return (False, f'clickhouse-client not found on port {port}', None)
+    except Exception as e:
+        return (False, str(e), None)
+
+    out = (r.stderr or r.stdout or b'').decode(errors='replace')
+    ok = (r.returncode == 0 and not out.strip().startswith('Code:'))
+    return (ok, out if not ok else r.stdout.decode(errors='replace'), r.returncode)
+
+
+def run_http_query(port, query, payload=None, compression=None, conf=None, timeout=60):
+    """POST a query (and optional payload) to the ClickHouse HTTP interface via curl.
+
+    With compression='gzip' the payload is gzipped and sent with Content-Encoding: gzip,
+    which ClickHouse decompresses server-side. Returns (ok, output, returncode).
+    """
+    host, username, password, database = _clickhouse_target(conf)
+    db_part = f"&database={urllib.parse.quote_plus(database)}" if database else ''
+    url = f"http://{host}:{port}/?query={urllib.parse.quote_plus(query)}{db_part}"
+    curl_cmd = ['curl', '-sS', '-X', 'POST', url, '--data-binary', '@-']
+    if username is not None and password is not None:
+        curl_cmd += ['--user', f"{username}:{password}"]
+
+    data = (payload or '').encode()
+    if compression == 'gzip':
+        data = gzip.compress(data, compresslevel=1)
+        curl_cmd += ['-H', 'Content-Encoding: gzip']
+
+    try:
+        r = subprocess.run(
+            curl_cmd,
+            input=data,
+            capture_output=True,
+            timeout=timeout
+        )
+    except Exception as e:
+        return (False, str(e), None)
+
+    out = (r.stdout or r.stderr or b'').decode(errors='replace')
+    ok = (r.returncode == 0 and not out.strip().startswith('Code:'))
+    return (ok, out, r.returncode)
+
+
+def query_clickhouse(query):
+    """Run a single statement (DDL, INSERT ... SELECT, small SELECT) using the same transport
+    order as inserts. Returns the output text, or None on failure.
+    """
+    try:
+        port_num = int(CLICKHOUSE_CONFIG.get('port', 0))
+    except Exception:
+        port_num = 0
+
+    attempts = []
+    if TRANSPORT:
+        attempts.append((TRANSPORT['transport'], TRANSPORT.get('port') or port_num))
+    for p in (9000, port_num):
+        if p and ('native', p) not in attempts and p not in (8123, 18123):
+            attempts.append(('native', p))
+    for p in (port_num, 18123, 8123):
+        if p in (8123, 18123) and ('http', p) not in attempts:
+            attempts.append(('http', p))
+
+    errors = []
+    for transport, p in attempts:
+        if transport == 'native':
+            ok, out, _ = run_client_query(p, query, timeout=3600)
+        else:
+            ok, out, _ = run_http_query(p, query, timeout=3600)
+        if ok:
+            return out
+        errors.append(f"{transport}:{p}: {out.strip()[:200]}")
+    print(f"✗ ClickHouse statement failed: {query[:120]}...\n  " + '\n  '.join(errors))
+    return None
+
+
+def run_clickhouse_statement(query):
+    """Run a single statement; returns True on success."""
+    return query_clickhouse(query) is not None
+
+
+_TABLE_TYPES = {}
+
+
+def table_types(table_name):
+    """Return {column: ClickHouse type} for table_name (cached), or None if it can't be described"""
+    if table_name not in _TABLE_TYPES:
+        out = query_clickhouse(f"DESCRIBE TABLE {table_name} FORMAT TabSeparated")
+        if out is None:
+            return None
+        _TABLE_TYPES[table_name] = {
+            line.split('\t')[0]: line.split('\t')[1] for line in out.splitlines() if '\t' in line
+        }
+    return _TABLE_TYPES[table_name]
+
+
+def insert_batch(rows, table='images_analytical', columns=None):
     """Insert batch into ClickHouse using JSONEachRow for safe NULL/array handling.
     To avoid very large payloads that can exhaust client memory (curl) or time out
     clickhouse-client, break inserts into smaller chunks of INSERT_CHUNK_SIZE.
+
+    If TRANSPORT was loaded from the probe config, its format is used for the payload
+    and its transport/port/compression is tried first for every chunk. With
+    WIRE_DICTIONARY, chunks are dictionary/prefix-encoded (see encode_insert).
+    table/columns default to images_analytical and INSERT_COLUMNS (plus landmark flags
+    when present); rollup inserts pass their own.
     """
     if not rows:
         return
 
-    # Column list must match the JSON object keys and the table schema
-    columns = [
-        'image_id','site_name_id','site_name','site_image_id','gender_id','gender','age_id','age','age_detail_id','location_id','country_code','region',
-        'keyword_ids','ethnicity_ids','ethnicity_white','ethnicity_black','ethnicity_asian','ethnicity_hispanic','ethnicity_middle_eastern','ethnicity_native_american','ethnicity_pacific_islander','ethnicity_mixed','ethnicity_other',
-        'has_face','has_body','has_feet','has_hands','has_left_hand','has_right_hand','is_face_distant','is_small','is_face_no_lms',
-        'face_x','face_y','face_z','mouth_gap',
-        'body_pose_cluster_256','body_pose_cluster_512','body_pose_cluster_768','hand_poses_cluster_32','hand_gesture_cluster_32','hand_gesture_cluster_64','hand_gesture_cluster_128','arms_poses3D_cluster_64','arm_poses3D_cluster_128','hand_position_cluster_128','hsv_cluster','meta_hsv_cluster','face_cluster',
-        'is_not_face_topic_id','is_not_face_score','is_face_model_topic_id','is_face_model_score','affect_id','affect_score','obj_cluster',
-        'topic_id_1','topic_score_1','topic_id_2','topic_score_2','topic_id_3','topic_score_3',
-        'detection_count','detection_classes','detection_top_class_id','detection_top_class_confidence',
-        'upload_date','author','caption','content_url','width','height','is_dupe_of','updated_at'
-    ]
-
     # Qualify table with configured database if provided to avoid default DB issues
     database = CLICKHOUSE_CONFIG.get('database')
-    table_name = f"{database}.images_analytical" if database else 'images_analytical'
+    table_name = f"{database}.{table}" if database else table
 
-    insert_query = f"INSERT INTO {table_name} ({', '.join(columns)}) FORMAT JSONEachRow"
+    if columns is None:
+        columns = INSERT_COLUMNS + [c for c in LANDMARK_FLAG_COLUMNS if c in rows[0]]
+    fmt = TRANSPORT['format'] if TRANSPORT else 'JSONEachRow'
+    types = table_types(table_name) if WIRE_DICTIONARY else None
 
     try:
-        # Normalize host and credentials
-        host = CLICKHOUSE_CONFIG['host']
-        if host == 'localhost':
-            host = '127.0.0.1'
-        username = CLICKHOUSE_CONFIG.get('username')
-        password = CLICKHOUSE_CONFIG.get('password')
-        database = CLICKHOUSE_CONFIG.get('database')
-
         try:
             port_num = int(CLICKHOUSE_CONFIG.get('port', 0))
         except Exception:
             port_num = 0
 
-        import urllib.parse
-
-        def run_insert_with_client(p, payload):
+        def run_insert_with_client(p, insert_query, payload, compression=None):
             # quick health-check (include auth/database to ensure accurate auth test)
-            health_cmd = ['clickhouse-client', '--host', host, '--port', str(p), '--query', 'SELECT 1']
-            if username is not None:
-                health_cmd += ['--user', username]
-            if password is not None:
-                health_cmd += ['--password', password]
-            if database is not None:
-                health_cmd += ['--database', database]
-
-            try:
-                health = subprocess.run(health_cmd, capture_output=True, text=True, timeout=10)
-            except FileNotFoundError:
-                return (False, f'clickhouse-client not found on port {p}', None)
-            except Exception as e:
-                return (False, f'health-check error on port {p}: {e}', None)
-
-            if health.returncode != 0:
-                return (False, f'health-check failed: {health.stderr or health.stdout}', health.returncode)
-
-            args = [
-                'clickhouse-client', '--host', host, '--port', str(p), '--query', insert_query
-            ]
-            if username is not None:
-                args += ['--user', username]
-            if password is not None:
-                args += ['--password', password]
-            if database is not None:
-                args += ['--database', database]
-
-            try:
-                r = subprocess.run(
-                    args,
-                    input=payload,
-                    capture_output=True,
-                    text=True,
-                    timeout=60
-                )
-                out = r.stderr or r.stdout or ''
-                ok = (r.returncode == 0 and not str(out).strip().startswith('Code:'))
-                return (ok, out, r.returncode)
-            except Exception as e:
-                return (False, str(e), None)
+            ok, out, rc = run_client_query(p, 'SELECT 1', timeout=10)
+            if not ok:
+                if rc is None:
+                    return (False, out, None)
+                return (False, f'health-check failed: {out}', rc)
+            return run_client_query(p, insert_query, payload, compression=compression)
 
         # Insert in smaller chunks
         total = len(rows)
@@ -452,28 +730,38 @@ def insert_batch(rows):
         chunks = list(range(0, total, INSERT_CHUNK_SIZE))
         for idx, start in enumerate(chunks):
             chunk_rows = rows[start:start + INSERT_CHUNK_SIZE]
-            # Build payload only for this chunk
-            payload = '\n'.join([json.dumps(row, default=str) for row in chunk_rows])
+            # Build query and payload only for this chunk
+            insert_query, payload = encode_insert(table_name, chunk_rows, fmt, columns, WIRE_DICTIONARY, types)
+            if PROFILER is not None:
+                PROFILER.checkpoint()
             print(f"  Inserting chunk {idx+1}/{len(chunks)} ({len(chunk_rows)} rows)")
 
             attempts = []
             ok = False
 
+            # 0) Probed transport from TRANSPORT_CONFIG_FILE
+            if TRANSPORT:
+                p = TRANSPORT.get('port') or port_num
+                print(f"  Trying probed transport {TRANSPORT['transport']}:{p} for this chunk...")
+                if TRANSPORT['transport'] == 'native':
+                    # No SELECT 1 health check here: the probe timed this path without one, and a
+                    # failure still falls through to the checked attempts below
+                    ok, out, rc = run_client_query(p, insert_query, payload, compression=TRANSPORT.get('compression'))
+                else:
+                    ok, out, rc = run_http_query(p, insert_query, payload, TRANSPORT.get('compression'))
+                attempts.append((f"probed-{TRANSPORT['transport']}:{p}", ok, out))
+
             # 1) Prefer native TCP port 9000 when available
-            if port_num != 9000:
+            if not ok and port_num != 9000:
                 print("  Trying clickhouse-client on port 9000 as primary for this chunk...")
-                ok, out, rc = run_insert_with_client(9000, payload)
+                ok, out, rc = run_insert_with_client(9000, insert_query, payload)
                 attempts.append((f'clickhouse-client:9000', ok, out))
-                if ok:
-                    result = types.SimpleNamespace(returncode=0, stdout=out, stderr='')
 
             # 2) Try clickhouse-client on configured port
             if not ok:
                 print(f"  Trying clickhouse-client on configured port {port_num} for this chunk...")
-                ok, out, rc = run_insert_with_client(port_num, payload)
+                ok, out, rc = run_insert_with_client(port_num, insert_query, payload)
                 attempts.append((f'clickhouse-client:{port_num}', ok, out))
-                if ok:
-                    result = types.SimpleNamespace(returncode=0, stdout=out, stderr='')
 
             # 3) Try HTTP POST to candidate HTTP ports (prefer configured, then 18123, then 8123)
             if not ok:
@@ -485,28 +773,11 @@ def insert_batch(rows):
                         candidate_ports.append(p)
 
                 for p in candidate_ports:
-                    db_part = f"&database={urllib.parse.quote_plus(database)}" if database else ''
-                    url = f"http://{host}:{p}/?query={urllib.parse.quote_plus(insert_query)}{db_part}"
-                    curl_cmd = ['curl', '-sS', '-X', 'POST', url, '--data-binary', '@-']
-                    if username is not None and password is not None:
-                        curl_cmd += ['--user', f"{username}:{password}"]
-                    print(f"  Trying HTTP POST to ClickHouse at {host}:{p} (curl) for this chunk...")
-                    try:
-                        r = subprocess.run(
-                            curl_cmd,
-                            input=payload,
-                            capture_output=True,
-                            text=True,
-                            timeout=60
-                        )
-                        out = r.stdout or r.stderr or ''
-                        ok = (r.returncode == 0 and not str(out).strip().startswith('Code:'))
-                        attempts.append((f'curl:{p}', ok, out))
-                        if ok:
-                            result = r
-                            break
-                    except Exception as e:
-                        attempts.append((f'curl-exc:{p}', False, str(e)))
+                    print(f"  Trying HTTP POST to ClickHouse at {_clickhouse_target()[0]}:{p} (curl) for this chunk...")
+                    ok, out, rc = run_http_query(p, insert_query, payload)
+                    attempts.append((f'curl:{p}', ok, out))
+                    if ok:
+                        break
 
             if not ok:
                 # Aggregate attempts for debugging
@@ -514,10 +785,6 @@ def insert_batch(rows):
                 print(f"✗ Insert failed for chunk {idx+1}/{len(chunks)} (all attempts):\n{details}")
                 raise Exception(f"ClickHouse insert error (chunk {idx+1}): {details}")
 
-            if result.returncode != 0:
-                print(f"✗ Insert failed for chunk {idx+1}: {result.stderr}")
-                raise Exception(f"ClickHouse insert error: {result.stderr}")
-
     except subprocess.TimeoutExpired:
         print(f"✗ Insert timed out")
         raise
@@ -525,17 +792,108 @@ def insert_batch(rows):
         print(f"✗ Insert error: {e}")
         raise
 
-def migrate_range(start_id, end_id):
-    """Migrate a range of image_ids"""
+def create_rollup_tables():
+    from migrate_rollups import create_table_queries
+
+    for query in create_table_queries(CLICKHOUSE_CONFIG.get('database')):
+        if not run_clickhouse_statement(query):
+            raise Exception("Could not create rollup tables")
+
+
+def insert_rollups(rows, counted_to):
+    """Count a transformed batch and insert the partial counts into each rollup table.
+
+    Rows below a table's progress mark are already counted and skipped. After each
+    table's insert its mark is moved to counted_to (the batch's exclusive end id).
+    """
+    from migrate_rollups import ROLLUP_TABLES, aggregate_batch, progress_query
+
+    database = CLICKHOUSE_CONFIG.get('database')
+    for table, spec in ROLLUP_TABLES.items():
+        done = ROLLUP_PROGRESS.get(table, 0)
+        if done >= counted_to:
+            continue
+        rollup_rows = aggregate_batch([r for r in rows if r['image_id'] >= done])[table]
+        print(f"  Rollup {table}: {len(rollup_rows)} keys")
+        insert_batch(rollup_rows, table=table, columns=spec['columns'])
+        if not run_clickhouse_statement(progress_query(table, counted_to, database)):
+            raise Exception(f"Could not record rollup progress for {table}")
+        ROLLUP_PROGRESS[table] = counted_to
+
+
+def catch_up_rollups(resume_id):
+    """Count rows already in images_analytical that the rollups missed, up to resume_id.
+
+    The main insert runs before the rollup insert, and a run resumes from
+    max(image_id) + 1. Rows of an interrupted batch (failed chunk, crash, failed
+    rollup insert) are therefore in images_analytical but in no rollup. This counts
+    [counted_to, resume_id) server-side for each rollup table and moves its mark.
+    """
+    from migrate_rollups import ROLLUP_TABLES, progress_query, range_query, read_progress_query
+
+    database = CLICKHOUSE_CONFIG.get('database')
+    out = query_clickhouse(read_progress_query(database))
+    if out is None:
+        raise Exception("Could not read rollup progress")
+    ROLLUP_PROGRESS.clear()
+    for line in out.splitlines():
+        if '\t' in line:
+            table, counted_to = line.split('\t')
+            ROLLUP_PROGRESS[table] = int(counted_to)
+
+    for table in ROLLUP_TABLES:
+        done = ROLLUP_PROGRESS.get(table)
+        if done is None:
+            existing = query_clickhouse(f"SELECT count() FROM {database + '.' if database else ''}{table}")
+            if existing is not None and existing.strip() not in ('', '0'):
+                print(f"  ⚠ {table} has rows but no progress mark (filled by an older run); counts may be off. "
+                      f"Run --rebuild-rollups to be sure.")
+                ROLLUP_PROGRESS[table] = resume_id
+                continue
+            done = 0
+        if done < resume_id:
+            print(f"  Rollup {table}: counting image_id {done} to {resume_id} from images_analytical")
+            if not run_clickhouse_statement(range_query(table, done, resume_id, database)):
+                raise Exception(f"Rollup catch-up failed for {table}")
+            if not run_clickhouse_statement(progress_query(table, resume_id, database)):
+                raise Exception(f"Could not record rollup progress for {table}")
+            ROLLUP_PROGRESS[table] = resume_id
+
+
+def rebuild_rollups():
+    """Recompute all rollups from images_analytical (after re-runs or a load without --rollups)"""
+    from migrate_rollups import rebuild_queries
+
+    create_rollup_tables()
+    for query in rebuild_queries(CLICKHOUSE_CONFIG.get('database')):
+        print(f"  {query[:100]}...")
+        if not run_clickhouse_statement(query):
+            raise Exception("Rollup rebuild failed")
+
+
+def migrate_range(start_id, end_id, profiler=None, max_batches=None):
+    """Migrate a range of image_ids.
+
+    If a MigrationProfiler is given, each stage runs inside profiler.stage(...)
+    so CPU samples and allocations are attributed per stage. max_batches stops
+    early after that many batches (used by --profile).
+    """
     mysql_conn = mysql.connector.connect(**MYSQL_CONFIG)
-    
+
+    def stage(name):
+        return profiler.stage(name) if profiler is not None else nullcontext()
+
     this_round_start = time.time()
     current_id = start_id
+    batches_done = 0
     while current_id < end_id:
+        if max_batches is not None and batches_done >= max_batches:
+            break
         batch_end = min(current_id + BATCH_SIZE, end_id)
         
         # Extract
-        mysql_rows = extract_batch(mysql_conn, current_id, batch_end)
+        with stage('extract'):
+            mysql_rows = extract_batch(mysql_conn, current_id, batch_end)
         print(f"Extracted {len(mysql_rows)} rows from MySQL for IDs {current_id} to {batch_end}")
         this_msql_time = time.time() - this_round_start
         print(f"  MySQL query time: {this_msql_time:.2f} seconds")
@@ -545,22 +903,32 @@ def migrate_range(start_id, end_id):
         #     json.dump(mysql_rows, f, default=str, indent=2)
 
         # Fetch many-to-many arrays for this batch
-        image_ids = [r['image_id'] for r in mysql_rows]
-        keywords_dict = fetch_array_map(mysql_conn, 'ImagesKeywords', 'keyword_id', image_ids)
-        ethnicity_dict = fetch_array_map(mysql_conn, 'ImagesEthnicity', 'ethnicity_id', image_ids)
+        with stage('fetch_arrays'):
+            image_ids = [r['image_id'] for r in mysql_rows]
+            keywords_dict = fetch_array_map(mysql_conn, 'ImagesKeywords', 'keyword_id', image_ids)
+            ethnicity_dict = fetch_array_map(mysql_conn, 'ImagesEthnicity', 'ethnicity_id', image_ids)
         mysql_array_time = time.time() - this_round_start - this_msql_time
         print(f"  MySQL array fetch time: {mysql_array_time:.2f} seconds")
 
         # Transform
-        transformed_rows = [transform_row(row, keywords_dict, ethnicity_dict) for row in mysql_rows]
+        with stage('transform'):
+            transformed_rows = [transform_row(row, keywords_dict, ethnicity_dict, PRESENCE) for row in mysql_rows]
 
         # Insert
-        insert_batch(transformed_rows)
+        with stage('insert'):
+            insert_batch(transformed_rows)
         insert_time = time.time() - this_round_start - this_msql_time - mysql_array_time
         print(f"  ClickHouse insert time: {insert_time:.2f} seconds")
 
+        # Rollups (only after the main insert succeeded, so counts match loaded rows;
+        # an interrupted batch is counted by catch_up_rollups on the next run)
+        if ROLLUPS:
+            with stage('rollups'):
+                insert_rollups(transformed_rows, batch_end)
+
         print(f"Migrated {current_id} to {batch_end}")
         current_id = batch_end
+        batches_done += 1
     
     mysql_conn.close()
 
@@ -572,6 +940,14 @@ if __name__ == '__main__':
     parser.add_argument('--end', type=int, default=None, help='End image_id (exclusive)')
     parser.add_argument('--dry-run', action='store_true', help='Do not insert; print transformed rows for inspection')
     parser.add_argument('--limit', type=int, default=10, help='Number of transformed rows to print in dry-run')
+    parser.add_argument('--wire-dict', action='store_true', help='Dictionary/prefix-encode repetitive string columns on the wire (also enabled by "dictionary" in the transport config)')
+    parser.add_argument('--presence-bitmaps', default=None, help='Directory of MongoDB presence bitmaps built by presence_bitmaps.py; adds landmark flags to each row')
+    parser.add_argument('--rollups', action='store_true', help='Also maintain the pre-aggregated rollup tables (migrate_rollups.py) batch by batch')
+    parser.add_argument('--rebuild-rollups', action='store_true', help='Recompute the rollup tables from images_analytical and exit')
+    parser.add_argument('--profile', action='store_true', help='Run real batches under CPU sampling and tracemalloc and report hot paths per stage')
+    parser.add_argument('--profile-batches', type=int, default=1, help='Number of batches to run in --profile mode')
+    parser.add_argument('--profile-batch-size', type=int, default=PROFILE_BATCH_SIZE, help='image_ids per batch in --profile mode')
+    parser.add_argument('--profile-out', default='migrate_profile', help='Output prefix for --profile (<prefix>.txt report, <prefix>.folded flamegraph stacks)')
     args = parser.parse_args()
 
     # Determine overall min/max from MySQL if not provided
@@ -596,6 +972,21 @@ if __name__ == '__main__':
         mysql_conn.close()
         raise SystemExit(1)
 
+    TRANSPORT = load_transport_config()
+    WIRE_DICTIONARY = args.wire_dict or bool(TRANSPORT and TRANSPORT.get('dictionary'))
+
+    if args.presence_bitmaps:
+        from presence_bitmaps import PresenceIndex
+
+        PRESENCE = PresenceIndex(args.presence_bitmaps)
+        print(f"Loaded presence bitmaps from {args.presence_bitmaps}: {', '.join(PRESENCE.flags)}")
+
+    if args.rebuild_rollups:
+        mysql_conn.close()
+        rebuild_rollups()
+        print("Rollup tables rebuilt")
+        raise SystemExit(0)
+
     if args.dry_run:
         # Extract a single batch for inspection
         batch_end = min(start + BATCH_SIZE, end)
@@ -605,7 +996,7 @@ if __name__ == '__main__':
         image_ids = [r['image_id'] for r in mysql_rows]
         keywords_dict = fetch_array_map(mysql_conn, 'ImagesKeywords', 'keyword_id', image_ids)
         ethnicity_dict = fetch_array_map(mysql_conn, 'ImagesEthnicity', 'ethnicity_id', image_ids)
-        transformed_rows = [transform_row(row, keywords_dict, ethnicity_dict) for row in mysql_rows]
+        transformed_rows = [transform_row(row, keywords_dict, ethnicity_dict, PRESENCE) for row in mysql_rows]
 
         print(f"Printing up to {args.limit} transformed rows (JSON):")
         for r in transformed_rows[:args.limit]:
@@ -616,4 +1007,24 @@ if __name__ == '__main__':
 
     mysql_conn.close()
 
+    if args.rollups:
+        create_rollup_tables()
+        catch_up_rollups(start)
+        ROLLUPS = True
+
+    if args.profile:
+        from migrate_profiler import MigrationProfiler
+
+        profiler = MigrationProfiler()
+        PROFILER = profiler
+        BATCH_SIZE = args.profile_batch_size
+        print(f"Profiling {args.profile_batches} batch(es) of {BATCH_SIZE} image_ids starting at {start}")
+        profiler.start()
+        try:
+            migrate_range(start, end, profiler=profiler, max_batches=args.profile_batches)
+        finally:
+            profiler.stop()
+            profiler.write(args.profile_out)
+        raise SystemExit(0)
+
     migrate_range(start, end)
\ No newline at end of file
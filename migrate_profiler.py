@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""CPU sampling and allocation profiler for migrate_data.py.
+
+Used by `python migrate_data.py --profile`. Each migration stage (extract,
+fetch_arrays, transform, insert) is wrapped in `profiler.stage(name)`; while a
+stage is active the profiler:
+
+  - samples the Python stack on a CPU timer (SIGPROF), so time spent waiting on
+    MySQL or clickhouse-client subprocesses is not counted, only our own CPU work
+  - diffs tracemalloc snapshots against the one taken at stage entry to find the
+    lines that allocated the most memory: at stage exit (what the stage left
+    behind, e.g. the dicts built by transform_row) and at profiler.checkpoint()
+    calls inside the stage (live temporaries, e.g. the json.dumps payload that
+    insert_batch builds and frees for every chunk); the checkpoint holding the
+    most memory per stage is reported
+
+Output:
+  - a per-stage report of top functions (self and cumulative samples) and top
+    allocation sites, printed and written to <prefix>.txt
+  - collapsed stacks in <prefix>.folded, one `stage;frame;frame count` line per
+    unique stack, which flamegraph.pl, speedscope and inferno read directly
+
+Only the standard library is used.
+"""
+
+import os
+import signal
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+DEFAULT_INTERVAL = 0.005  # seconds of CPU time between samples
+DEFAULT_TOP = 15
+TRACEMALLOC_FRAMES = 1  # only the allocating line is reported; deeper tracebacks slow tracing a lot
+# checkpoint() snapshots (slow with a big heap) only when traced memory has grown by this
+# factor since the stage's last checkpoint snapshot, so per-chunk calls stay cheap
+CHECKPOINT_GROWTH = 1.1
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class MigrationProfiler:
+    """Collect CPU samples and allocation diffs per migration stage."""
+
+    def __init__(self, interval=DEFAULT_INTERVAL, top=DEFAULT_TOP):
+        self.interval = interval
+        self.top = top
+        self.current_stage = None
+        # stage -> Counter of stack tuples (root first)
+        self.stacks = defaultdict(Counter)
+        # stage -> {(filename, lineno): [size_diff, count_diff]}
+        self.allocations = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+        # stage -> allocation sites at the checkpoint() with the most live memory
+        self.checkpoint_allocations = {}
+        self.checkpoint_bytes = Counter()
+        # stage -> traced memory at its last checkpoint snapshot / seconds spent in checkpoints
+        self._checkpoint_traced = Counter()
+        self.checkpoint_seconds = Counter()
+        # stage -> tracemalloc snapshot taken at stage entry
+        self._entry_snapshots = {}
+        self.stage_seconds = Counter()
+        self.stage_peak = Counter()
+        self.sampling = hasattr(signal, 'SIGPROF') and hasattr(signal, 'setitimer')
+        self._previous_handler = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        if self.sampling:
+            self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        else:
+            print("  SIGPROF not available on this platform; CPU sampling disabled (allocations only)")
+
+    def stop(self):
+        if self.sampling:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        tracemalloc.stop()
+
+    def _sample(self, signum, frame):
+        stage = self.current_stage
+        if stage is None or frame is None:
+            return
+        stack = []
+        while frame is not None:
+            stack.append(_frame_label(frame))
+            frame = frame.f_back
+        stack.reverse()
+        self.stacks[stage][tuple(stack)] += 1
+
+    @contextmanager
+    def stage(self, name):
+        """Attribute CPU samples and allocations inside the block to `name`."""
+        previous = self.current_stage
+        previous_snapshot = self._entry_snapshots.get(name)
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        self._entry_snapshots[name] = before
+        started = time.time()
+        checkpoint_seconds = self.checkpoint_seconds[name]
+        self.current_stage = name
+        try:
+            yield
+        finally:
+            self.current_stage = previous
+            # Profiler overhead (checkpoint snapshots) is not part of the stage's wall time
+            self.stage_seconds[name] += time.time() - started - (self.checkpoint_seconds[name] - checkpoint_seconds)
+            _, peak = tracemalloc.get_traced_memory()
+            self.stage_peak[name] = max(self.stage_peak[name], peak)
+            after = tracemalloc.take_snapshot()
+            for site, (size, count) in self._allocation_sites(before, after).items():
+                entry = self.allocations[name][site]
+                entry[0] += size
+                entry[1] += count
+            if previous_snapshot is None:
+                del self._entry_snapshots[name]
+            else:
+                self._entry_snapshots[name] = previous_snapshot
+
+    def checkpoint(self):
+        """Record the live allocation sites of the current stage, relative to its entry.
+
+        Call it where a stage holds its largest temporaries (e.g. right after
+        insert_batch encodes a chunk payload); transient allocations freed before
+        the stage exits are otherwise invisible. No-op outside a stage, and
+        cheap unless traced memory grew by CHECKPOINT_GROWTH since the stage's
+        last checkpoint snapshot.
+        """
+        name = self.current_stage
+        if name is None or name not in self._entry_snapshots or not tracemalloc.is_tracing():
+            return
+        traced, _ = tracemalloc.get_traced_memory()
+        if traced <= self._checkpoint_traced[name] * CHECKPOINT_GROWTH:
+            return
+        self._checkpoint_traced[name] = traced
+        # Don't attribute the snapshot diff's own CPU time to the stage
+        started = time.time()
+        self.current_stage = None
+        try:
+            sites = self._allocation_sites(self._entry_snapshots[name], tracemalloc.take_snapshot())
+        finally:
+            self.current_stage = name
+            self.checkpoint_seconds[name] += time.time() - started
+        live = sum(size for size, _ in sites.values())
+        if live > self.checkpoint_bytes[name]:
+            self.checkpoint_bytes[name] = live
+            self.checkpoint_allocations[name] = sites
+
+    def _allocation_sites(self, before, after):
+        """Return {(filename, lineno): (size_diff, count_diff)} for lines that grew between snapshots."""
+        # Ignore tracemalloc's own bookkeeping and this module. Checked per
+        # statistic because Snapshot.filter_traces is very slow on big snapshots.
+        ignored = (tracemalloc.__file__, __file__)
+        sites = {}
+        for stat in after.compare_to(before, 'lineno'):
+            if stat.size_diff <= 0:
+                continue
+            frame = stat.traceback[0]
+            if frame.filename in ignored:
+                continue
+            sites[(frame.filename, frame.lineno)] = (stat.size_diff, stat.count_diff)
+        return sites
+
+    def report(self):
+        """Return the per-stage report as a string."""
+        lines = []
+        for name in self.stage_seconds:
+            stacks = self.stacks.get(name, Counter())
+            total = sum(stacks.values())
+            lines.append(f"=== Stage: {name} ===")
+            lines.append(f"  wall time: {self.stage_seconds[name]:.2f}s "
+                         f"(+{self.checkpoint_seconds[name]:.2f}s profiler checkpoints), CPU samples: {total}, "
+                         f"peak traced memory: {self.stage_peak[name] / 1e6:.1f} MB")
+
+            if total:
+                self_counts = Counter()
+                cumulative = Counter()
+                for stack, count in stacks.items():
+                    self_counts[stack[-1]] += count
+                    for label in set(stack):
+                        cumulative[label] += count
+                lines.append("  Top functions (self):")
+                for label, count in self_counts.most_common(self.top):
+                    lines.append(f"    {count / total:6.1%}  {count:6d}  {label}")
+                lines.append("  Top functions (cumulative):")
+                for label, count in cumulative.most_common(self.top):
+                    lines.append(f"    {count / total:6.1%}  {count:6d}  {label}")
+
+            sites = sorted(self.checkpoint_allocations.get(name, {}).items(), key=lambda kv: kv[1][0], reverse=True)
+            if sites:
+                lines.append(f"  Top allocation sites (live at the largest checkpoint, "
+                             f"{self.checkpoint_bytes[name] / 1e6:.1f} MB above stage entry; includes temporaries):")
+                for (filename, lineno), (size, count) in sites[:self.top]:
+                    lines.append(f"    {size / 1e6:9.2f} MB  {count:9d} blocks  {filename}:{lineno}")
+
+            sites = sorted(self.allocations.get(name, {}).items(), key=lambda kv: kv[1][0], reverse=True)
+            if sites:
+                lines.append("  Top allocation sites (net bytes retained at stage exit; "
+                             "temporaries freed inside the stage are not included):")
+                for (filename, lineno), (size, count) in sites[:self.top]:
+                    lines.append(f"    {size / 1e6:9.2f} MB  {count:9d} blocks  {filename}:{lineno}")
+            lines.append('')
+        return '\n'.join(lines)
+
+    def write(self, prefix):
+        """Write <prefix>.txt (report) and <prefix>.folded (collapsed stacks)."""
+        report = self.report()
+        print(report)
+        with open(f"{prefix}.txt", 'w') as f:
+            f.write(report)
+        with open(f"{prefix}.folded", 'w') as f:
+            for name, stacks in self.stacks.items():
+                for stack, count in stacks.items():
+                    frames = ';'.join(label.replace(';', ':') for label in stack)
+                    f.write(f"{name};{frames} {count}\n")
+        print(f"Profile report written to {prefix}.txt")
+        print(f"Collapsed stacks written to {prefix}.folded (e.g. flamegraph.pl {prefix}.folded > {prefix}.svg)")
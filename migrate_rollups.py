@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""Pre-aggregated rollup tables maintained by migrate_data.py while it loads.
+
+The chat agent's common questions (counts by cluster, keyword, country, topic
+score) otherwise rescan the full wide images_analytical table. With
+`migrate_data.py --rollups`, every batch is also counted in Python and the
+partial counts are inserted into small SummingMergeTree tables, which
+ClickHouse sums together during merges.
+
+Always read them with sum(), because rows for the same key from different
+batches are only merged in the background:
+
+    SELECT cluster_id, sum(image_count) FROM images_rollup_cluster
+    WHERE cluster_type = 'body_pose_cluster_512' GROUP BY cluster_id
+
+Unlike images_analytical (ReplacingMergeTree), re-inserting a batch counts it
+twice. After re-running a range, rebuild the rollups from the source table with
+`migrate_data.py --rebuild-rollups`.
+
+The opposite can happen too: a batch's rows reach images_analytical but its
+counts never reach a rollup (a later chunk of the batch failed, the process
+died, or a rollup insert failed). migrate_data.py resumes from
+max(image_id) + 1, so those rows would never be counted. To prevent that, each
+rollup's progress is recorded in PROGRESS_TABLE (rows with image_id below
+counted_to are counted), and on start-up migrate_data.py --rollups counts the
+rows between that mark and the resume point server-side (range_query).
+"""
+
+from collections import Counter
+
+# Columns counted per cluster_type in images_rollup_cluster (NULL = unclustered, skipped)
+CLUSTER_COLUMNS = [
+    'body_pose_cluster_256', 'body_pose_cluster_512', 'body_pose_cluster_768',
+    'hand_poses_cluster_32', 'hand_gesture_cluster_32', 'hand_gesture_cluster_64', 'hand_gesture_cluster_128',
+    'arms_poses3D_cluster_64', 'arm_poses3D_cluster_128', 'hand_position_cluster_128',
+    'hsv_cluster', 'meta_hsv_cluster', 'face_cluster', 'obj_cluster',
+]
+
+TOPIC_SLOTS = (1, 2, 3)
+# Topic scores are bucketed into SCORE_BUCKETS equal-width bins over [0, 1]
+SCORE_BUCKETS = 20
+
+COUNT_COMMENT = "Partial counts per load batch: always aggregate with sum(image_count)"
+
+# Per rollup table: images_analytical rows with image_id < counted_to are included.
+# ReplacingMergeTree(counted_to) keeps the highest mark; read it with max().
+PROGRESS_TABLE = 'images_rollup_progress'
+PROGRESS_DDL = """
+    rollup_table LowCardinality(String),
+    counted_to UInt64 COMMENT 'images_analytical rows with image_id < counted_to are counted in rollup_table'
+"""
+
+ROLLUP_TABLES = {
+    'images_rollup_cluster': {
+        'columns': ['cluster_type', 'cluster_id', 'site_name_id', 'gender_id', 'image_count'],
+        'ddl': """
+            cluster_type LowCardinality(String) COMMENT 'images_analytical cluster column name, e.g. body_pose_cluster_512',
+            cluster_id UInt16,
+            site_name_id UInt32,
+            gender_id UInt16,
+            image_count UInt64 COMMENT '{count_comment}'
+        """,
+        'order_by': '(cluster_type, cluster_id, site_name_id, gender_id)',
+    },
+    'images_rollup_keyword': {
+        'columns': ['keyword_id', 'site_name_id', 'image_count'],
+        'ddl': """
+            keyword_id UInt32,
+            site_name_id UInt32,
+            image_count UInt64 COMMENT '{count_comment}'
+        """,
+        'order_by': '(keyword_id, site_name_id)',
+    },
+    'images_rollup_country': {
+        'columns': ['country_code', 'region', 'site_name_id', 'gender_id', 'image_count'],
+        'ddl': """
+            country_code LowCardinality(String),
+            region LowCardinality(String),
+            site_name_id UInt32,
+            gender_id UInt16,
+            image_count UInt64 COMMENT '{count_comment}'
+        """,
+        'order_by': '(country_code, region, site_name_id, gender_id)',
+    },
+    'images_rollup_topic_score': {
+        'columns': ['topic_slot', 'topic_id', 'score_bucket', 'image_count'],
+        'ddl': """
+            topic_slot UInt8 COMMENT '1, 2 or 3: which topic_id_N/topic_score_N pair',
+            topic_id UInt16,
+            score_bucket Float32 COMMENT 'Lower bound of a 1/{buckets}-wide topic score bin',
+            image_count UInt64 COMMENT '{count_comment}'
+        """,
+        'order_by': '(topic_slot, topic_id, score_bucket)',
+    },
+}
+
+
+def _score_bucket(score):
+    bucket = min(int(float(score) * SCORE_BUCKETS), SCORE_BUCKETS - 1)
+    return round(max(bucket, 0) / SCORE_BUCKETS, 4)
+
+
+def create_table_queries(database=None):
+    """CREATE TABLE IF NOT EXISTS statements for every rollup table."""
+    queries = []
+    for name, spec in ROLLUP_TABLES.items():
+        table = f"{database}.{name}" if database else name
+        columns = spec['ddl'].format(count_comment=COUNT_COMMENT, buckets=SCORE_BUCKETS).strip()
+        queries.append(
+            f"CREATE TABLE IF NOT EXISTS {table} ({columns}) "
+            f"ENGINE = SummingMergeTree(image_count) ORDER BY {spec['order_by']}"
+        )
+    table = f"{database}.{PROGRESS_TABLE}" if database else PROGRESS_TABLE
+    queries.append(
+        f"CREATE TABLE IF NOT EXISTS {table} ({PROGRESS_DDL.strip()}) "
+        f"ENGINE = ReplacingMergeTree(counted_to) ORDER BY rollup_table"
+    )
+    return queries
+
+
+def _rollup_selects(source, condition=None):
+    """SELECT per rollup table counting rows of `source`, optionally restricted by `condition`."""
+    def where(*conditions):
+        conditions = [c for c in conditions + (condition,) if c]
+        return f" WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    cluster_selects = ' UNION ALL '.join(
+        f"SELECT '{c}' AS cluster_type, assumeNotNull({c}) AS cluster_id, site_name_id, gender_id, count() AS image_count "
+        f"FROM {source}{where(f'{c} IS NOT NULL')} GROUP BY cluster_id, site_name_id, gender_id"
+        for c in CLUSTER_COLUMNS
+    )
+    topic_selects = ' UNION ALL '.join(
+        f"SELECT {n} AS topic_slot, assumeNotNull(topic_id_{n}) AS topic_id, "
+        f"least(toUInt32(greatest(ifNull(topic_score_{n}, 0), 0) * {SCORE_BUCKETS}), {SCORE_BUCKETS - 1}) / {SCORE_BUCKETS} AS score_bucket, "
+        f"count() AS image_count FROM {source}{where(f'topic_id_{n} IS NOT NULL', f'topic_id_{n} != 0')} "
+        f"GROUP BY topic_id, score_bucket"
+        for n in TOPIC_SLOTS
+    )
+    return {
+        'images_rollup_cluster': cluster_selects,
+        'images_rollup_keyword': (
+            f"SELECT keyword_id, site_name_id, count() AS image_count FROM {source} "
+            f"ARRAY JOIN keyword_ids AS keyword_id{where()} GROUP BY keyword_id, site_name_id"
+        ),
+        'images_rollup_country': (
+            f"SELECT country_code, region, site_name_id, gender_id, count() AS image_count FROM {source}{where()} "
+            f"GROUP BY country_code, region, site_name_id, gender_id"
+        ),
+        'images_rollup_topic_score': topic_selects,
+    }
+
+
+def rebuild_queries(database=None):
+    """Truncate each rollup and recompute it server-side from images_analytical FINAL."""
+    prefix = f"{database}." if database else ''
+    selects = _rollup_selects(f"{prefix}images_analytical FINAL")
+    queries = [f"TRUNCATE TABLE IF EXISTS {prefix}{PROGRESS_TABLE}"]
+    for name, spec in ROLLUP_TABLES.items():
+        table = f"{prefix}{name}"
+        queries.append(f"TRUNCATE TABLE IF EXISTS {table}")
+        queries.append(f"INSERT INTO {table} ({', '.join(spec['columns'])}) {selects[name]}")
+    # Everything loaded so far is now counted
+    names = ', '.join(f"'{name}'" for name in ROLLUP_TABLES)
+    queries.append(
+        f"INSERT INTO {prefix}{PROGRESS_TABLE} (rollup_table, counted_to) "
+        f"SELECT arrayJoin([{names}]), max(image_id) + 1 FROM {prefix}images_analytical"
+    )
+    return queries
+
+
+def range_query(table, start_id, end_id, database=None):
+    """INSERT counting images_analytical FINAL rows with start_id <= image_id < end_id into one rollup."""
+    prefix = f"{database}." if database else ''
+    select = _rollup_selects(f"{prefix}images_analytical FINAL",
+                             f"image_id >= {int(start_id)} AND image_id < {int(end_id)}")[table]
+    return f"INSERT INTO {prefix}{table} ({', '.join(ROLLUP_TABLES[table]['columns'])}) {select}"
+
+
+def progress_query(table, counted_to, database=None):
+    """INSERT recording that `table` counts every row with image_id < counted_to."""
+    prefix = f"{database}." if database else ''
+    return f"INSERT INTO {prefix}{PROGRESS_TABLE} (rollup_table, counted_to) VALUES ('{table}', {int(counted_to)})"
+
+
+def read_progress_query(database=None):
+    """SELECT returning (rollup_table, counted_to) rows as TabSeparated."""
+    prefix = f"{database}." if database else ''
+    return (f"SELECT rollup_table, max(counted_to) FROM {prefix}{PROGRESS_TABLE} "
+            f"GROUP BY rollup_table FORMAT TabSeparated")
+
+
+def aggregate_batch(rows):
+    """Count transformed rows into {table: [row dict, ...]} partial rollups."""
+    clusters = Counter()
+    keywords = Counter()
+    countries = Counter()
+    topics = Counter()
+
+    for row in rows:
+        site_name_id = row['site_name_id']
+        gender_id = row['gender_id']
+        for column in CLUSTER_COLUMNS:
+            cluster_id = row.get(column)
+            if cluster_id is not None:
+                clusters[(column, cluster_id, site_name_id, gender_id)] += 1
+        for keyword_id in row['keyword_ids']:
+            keywords[(keyword_id, site_name_id)] += 1
+        countries[(row['country_code'], row['region'], site_name_id, gender_id)] += 1
+        for n in TOPIC_SLOTS:
+            topic_id = row.get(f'topic_id_{n}')
+            if topic_id:
+                topics[(n, topic_id, _score_bucket(row.get(f'topic_score_{n}') or 0.0))] += 1
+
+    counters = {
+        'images_rollup_cluster': clusters,
+        'images_rollup_keyword': keywords,
+        'images_rollup_country': countries,
+        'images_rollup_topic_score': topics,
+    }
+    result = {}
+    for name, counter in counters.items():
+        columns = ROLLUP_TABLES[name]['columns']
+        result[name] = [dict(zip(columns, key + (count,))) for key, count in counter.items()]
+    return result
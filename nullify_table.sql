@@ -31,9 +31,9 @@ CREATE TABLE IF NOT EXISTS local.images_analytical
 (
     image_id UInt64,
     site_name_id UInt32,
-    site_name String,
+    site_name LowCardinality(String),
     site_image_id String,
-    author String,
+    author LowCardinality(String),
     caption String,
     content_url String,
     width UInt32,
@@ -42,13 +42,13 @@ CREATE TABLE IF NOT EXISTS local.images_analytical
 
     -- Demographics
     gender_id UInt16,
-    gender String,
+    gender LowCardinality(String),
     age_id UInt16,
-    age String,
+    age LowCardinality(String),
     age_detail_id UInt16,
     location_id UInt32,
-    country_code String,
-    region String,
+    country_code LowCardinality(String),
+    region LowCardinality(String),
 
     -- Many-to-many arrays
     keyword_ids Array(UInt32),
@@ -76,6 +76,13 @@ CREATE TABLE IF NOT EXISTS local.images_analytical
     is_small UInt8,
     is_face_no_lms UInt8,
 
+    -- MongoDB landmark presence flags (presence_bitmaps.py)
+    has_face_landmarks UInt8 DEFAULT 0,
+    has_body_landmarks UInt8 DEFAULT 0,
+    has_face_encodings UInt8 DEFAULT 0,
+    has_body_world_landmarks UInt8 DEFAULT 0,
+    has_body_landmarks_norm UInt8 DEFAULT 0,
+
     -- Face orientation
     face_x Float32,
     face_y Float32,
@@ -124,4 +131,23 @@ CREATE TABLE IF NOT EXISTS local.images_analytical
     is_dupe_of UInt64,
     updated_at DateTime
 ) ENGINE = ReplacingMergeTree(updated_at)
-ORDER BY (site_name_id, upload_date, image_id);
\ No newline at end of file
+ORDER BY (site_name_id, upload_date, image_id);
+
+
+-- add the MongoDB landmark presence flags to an existing table (not key columns, so ALTER is safe)
+ALTER TABLE local.images_analytical
+    ADD COLUMN IF NOT EXISTS has_face_landmarks UInt8 DEFAULT 0 AFTER is_face_no_lms,
+    ADD COLUMN IF NOT EXISTS has_body_landmarks UInt8 DEFAULT 0 AFTER has_face_landmarks,
+    ADD COLUMN IF NOT EXISTS has_face_encodings UInt8 DEFAULT 0 AFTER has_body_landmarks,
+    ADD COLUMN IF NOT EXISTS has_body_world_landmarks UInt8 DEFAULT 0 AFTER has_face_encodings,
+    ADD COLUMN IF NOT EXISTS has_body_landmarks_norm UInt8 DEFAULT 0 AFTER has_body_world_landmarks;
+
+-- repetitive strings as LowCardinality (dictionary-encoded on disk, matching the moose model);
+-- not key columns, so MODIFY COLUMN is safe (it rewrites these columns' data in the background)
+ALTER TABLE local.images_analytical
+    MODIFY COLUMN site_name LowCardinality(String),
+    MODIFY COLUMN author LowCardinality(String),
+    MODIFY COLUMN gender LowCardinality(String),
+    MODIFY COLUMN age LowCardinality(String),
+    MODIFY COLUMN country_code LowCardinality(String),
+    MODIFY COLUMN region LowCardinality(String);
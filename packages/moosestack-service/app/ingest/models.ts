@@ -130,6 +130,18 @@ export interface ImagesAnalytical {
   /** Face has no landmarks flag (0/1) */
   is_face_no_lms: boolean;
 
+  // MongoDB landmark presence flags (from presence_bitmaps.py, 0 if not loaded)
+  /** Face landmarks present in MongoDB encodings (0/1) */
+  has_face_landmarks: boolean;
+  /** Body landmarks present in MongoDB encodings (0/1) */
+  has_body_landmarks: boolean;
+  /** 68-point face encodings present in MongoDB encodings (0/1) */
+  has_face_encodings: boolean;
+  /** Body world landmarks present in MongoDB (0/1) */
+  has_body_world_landmarks: boolean;
+  /** Normalized body landmarks present in MongoDB (0/1) */
+  has_body_landmarks_norm: boolean;
+
   // Face Orientation (for "looking at camera" queries)
   // Use 0.0 for unknown/missing face orientation to avoid nullable performance penalty
   /** Face yaw angle - 0.0 = unknown/no face */
@@ -7,6 +7,7 @@ When users ask questions:
 3. Return clear, concise answers
 4. If a tool is available for a task, use it rather than making assumptions
 5. Format results appropriately for easy reading
+6. For counts by cluster, keyword, country/region or topic score, prefer the small images_rollup_* tables over scanning images_analytical, and always aggregate them with sum(image_count)
 
 Be helpful, accurate, and transparent about what tools you're using.`;
 }
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""Memory-mapped presence bitmaps for the MongoDB landmark collections.
+
+The landmark collections hold large binary BSON blobs, but the analytical table
+only needs to know whether each image has them. Instead of the `$out` + CSV +
+manual join workflow in data-migration.md, this module streams image_ids once
+into one bitmap file per flag (bit N set = image_id N has the data) and
+migrate_data.transform_row looks flags up in O(1) with no Mongo round-trip.
+
+Files live in a directory as `<flag>.bitmap`: raw bytes, bit (image_id & 7) of
+byte (image_id >> 3). 200M image_ids take 25 MB per flag, and pages are only
+read in as they are touched.
+
+Usage:
+  # Build from MongoDB (needs pymongo and `mongo = {'uri': ..., 'database': ...}` in myPasswords)
+  python presence_bitmaps.py build --out presence_bitmaps
+  # ...or from the mongoexport CSVs described in data-migration.md
+  python presence_bitmaps.py build --out presence_bitmaps --csv encodings_flags.csv hand_flags.csv ...
+  # Check counts
+  python presence_bitmaps.py stats --dir presence_bitmaps
+
+  python migrate_data.py --presence-bitmaps presence_bitmaps
+"""
+
+import csv
+import mmap
+import os
+
+BITMAP_SUFFIX = '.bitmap'
+MONGO_BATCH_SIZE = 50000
+PROGRESS_EVERY = 1000000
+
+# flag -> (collection, field). field=None means "a document exists for this image_id".
+# has_left_hand / has_right_hand are OR-ed into the MySQL-derived columns of the same name;
+# the other flags are their own columns (see LANDMARK_FLAG_COLUMNS in migrate_data.py).
+PRESENCE_FLAGS = {
+    'has_face_landmarks': ('encodings', 'face_landmarks'),
+    'has_body_landmarks': ('encodings', 'body_landmarks'),
+    'has_face_encodings': ('encodings', 'face_encodings68'),
+    'has_body_world_landmarks': ('body_world_landmarks', None),
+    'has_body_landmarks_norm': ('body_landmarks_norm', None),
+    'has_left_hand': ('hand_landmarks', 'left_hand'),
+    'has_right_hand': ('hand_landmarks', 'right_hand'),
+}
+
+
+class PresenceBitmap:
+    """A file-backed bit array indexed by image_id."""
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        if writable and not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.truncate(1)
+        self._file = open(path, 'r+b' if writable else 'rb')
+        self._map = None
+        self._size = 0
+        self._remap()
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+        self._size = os.fstat(self._file.fileno()).st_size
+        if self._size == 0:
+            self._map = None
+            return
+        access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+        self._map = mmap.mmap(self._file.fileno(), self._size, access=access)
+
+    def _grow(self, min_size):
+        new_size = max(min_size, self._size * 2)
+        self._map.flush()
+        self._file.truncate(new_size)
+        self._remap()
+
+    def set(self, image_id):
+        byte = image_id >> 3
+        if byte >= self._size:
+            self._grow(byte + 1)
+        self._map[byte] |= 1 << (image_id & 7)
+
+    def get(self, image_id):
+        """Return 1 if image_id is set, else 0."""
+        byte = image_id >> 3
+        if byte >= self._size or image_id < 0:
+            return 0
+        return (self._map[byte] >> (image_id & 7)) & 1
+
+    def count(self):
+        if self._map is None:
+            return 0
+        total = 0
+        for start in range(0, self._size, 1 << 20):
+            total += bin(int.from_bytes(self._map[start:start + (1 << 20)], 'little')).count('1')
+        return total
+
+    def close(self):
+        if self._map is not None:
+            if self.writable:
+                self._map.flush()
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+
+class PresenceIndex:
+    """All flag bitmaps found in a directory, for lookups during transform."""
+
+    def __init__(self, directory):
+        self.bitmaps = {}
+        for flag in PRESENCE_FLAGS:
+            path = os.path.join(directory, flag + BITMAP_SUFFIX)
+            if os.path.exists(path):
+                self.bitmaps[flag] = PresenceBitmap(path)
+        if not self.bitmaps:
+            raise FileNotFoundError(f"No {BITMAP_SUFFIX} files found in {directory}")
+
+    @property
+    def flags(self):
+        return list(self.bitmaps)
+
+    def lookup(self, image_id):
+        """Return {flag: 0/1} for every loaded flag."""
+        return {flag: bitmap.get(image_id) for flag, bitmap in self.bitmaps.items()}
+
+    def close(self):
+        for bitmap in self.bitmaps.values():
+            bitmap.close()
+
+
+def _open_for_build(directory, flags):
+    os.makedirs(directory, exist_ok=True)
+    bitmaps = {}
+    for flag in flags:
+        path = os.path.join(directory, flag + BITMAP_SUFFIX)
+        # Rebuild from scratch so removed documents don't leave stale bits
+        if os.path.exists(path):
+            os.remove(path)
+        bitmaps[flag] = PresenceBitmap(path, writable=True)
+    return bitmaps
+
+
+def build_from_mongo(directory, mongo_config, flags=None):
+    """Stream image_ids from each collection into bitmaps.
+
+    One aggregation per collection projects only image_id plus 0/1 flags computed
+    server-side, so the landmark blobs never leave MongoDB.
+    """
+    from pymongo import MongoClient
+
+    flags = list(flags or PRESENCE_FLAGS)
+    by_collection = {}
+    for flag in flags:
+        collection, field = PRESENCE_FLAGS[flag]
+        by_collection.setdefault(collection, []).append((flag, field))
+
+    client = MongoClient(mongo_config['uri'])
+    db = client[mongo_config['database']]
+    bitmaps = _open_for_build(directory, flags)
+    try:
+        for collection, flag_fields in by_collection.items():
+            project = {'_id': 0, 'image_id': 1}
+            for flag, field in flag_fields:
+                project[flag] = {'$literal': 1} if field is None else {'$cond': [{'$ifNull': [f'${field}', False]}, 1, 0]}
+            print(f"Streaming image_ids from {collection} for {', '.join(f for f, _ in flag_fields)}...")
+            cursor = db[collection].aggregate([{'$project': project}], allowDiskUse=True, batchSize=MONGO_BATCH_SIZE)
+            seen = 0
+            for doc in cursor:
+                image_id = doc.get('image_id')
+                if image_id is None:
+                    continue
+                image_id = int(image_id)
+                for flag, _ in flag_fields:
+                    if doc.get(flag):
+                        bitmaps[flag].set(image_id)
+                seen += 1
+                if seen % PROGRESS_EVERY == 0:
+                    print(f"  {collection}: {seen} documents")
+            print(f"  {collection}: {seen} documents done")
+    finally:
+        for bitmap in bitmaps.values():
+            bitmap.close()
+        client.close()
+
+
+def build_from_csv(directory, csv_paths):
+    """Build bitmaps from mongoexport CSVs (image_id plus one column per flag).
+
+    Column names may be the flag names or the hand_flags.csv names
+    (has_left_hand / has_right_hand), which match. A value of 1/true sets the bit.
+    """
+    bitmaps = {}
+    try:
+        for path in csv_paths:
+            with open(path, newline='') as f:
+                reader = csv.DictReader(f)
+                flag_columns = [c for c in reader.fieldnames or [] if c in PRESENCE_FLAGS]
+                if 'image_id' not in (reader.fieldnames or []) or not flag_columns:
+                    print(f"Skipping {path}: needs image_id and at least one of {', '.join(PRESENCE_FLAGS)}")
+                    continue
+                bitmaps.update(_open_for_build(directory, [c for c in flag_columns if c not in bitmaps]))
+                print(f"Loading {', '.join(flag_columns)} from {path}...")
+                for row in reader:
+                    if not row['image_id']:
+                        continue
+                    image_id = int(float(row['image_id']))
+                    for flag in flag_columns:
+                        if row[flag] not in ('', '0', 'false', 'False', 'null'):
+                            bitmaps[flag].set(image_id)
+    finally:
+        for bitmap in bitmaps.values():
+            bitmap.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build or inspect MongoDB presence-flag bitmaps')
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help='Build bitmaps from MongoDB or mongoexport CSVs')
+    build.add_argument('--out', default='presence_bitmaps', help='Output directory')
+    build.add_argument('--csv', nargs='+', default=None, help='Build from these CSV exports instead of querying MongoDB')
+    build.add_argument('--flags', nargs='+', default=None, choices=list(PRESENCE_FLAGS), help='Only build these flags (MongoDB mode)')
+    stats = sub.add_parser('stats', help='Print the number of set bits per flag')
+    stats.add_argument('--dir', default='presence_bitmaps', help='Bitmap directory')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if args.csv:
+            build_from_csv(args.out, args.csv)
+        else:
+            import myPasswords
+            build_from_mongo(args.out, myPasswords.mongo, args.flags)
+        args.dir = args.out
+
+    index = PresenceIndex(args.dir)
+    for flag, bitmap in index.bitmaps.items():
+        print(f"  {flag}: {bitmap.count()} image_ids")
+    index.close()
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
-"""Simple ClickHouse connection tester.
+"""Simple ClickHouse connection tester and insert transport probe.
 
 Usage:
   python test_connection.py
+  python test_connection.py --probe [--probe-rows 10000] [--probe-out clickhouse_transport.json]
 
 It reads ClickHouse config from `myPasswords.clickhouse` (if available) or environment vars:
   CLICKHOUSE_HOST, CLICKHOUSE_PORT, CLICKHOUSE_USER, CLICKHOUSE_PASSWORD
@@ -12,6 +13,13 @@ Tests performed:
   - HTTP GET to /?query=SELECT%201
   - clickhouse-client --query "SELECT version()"
 
+Probe mode (--probe) additionally inserts a sample batch (rows already in images_analytical,
+or the fixture rows run through migrate_data.transform_row while it is empty) into a scratch table over every reachable transport
+(clickhouse-client on the native port, curl on HTTP 8123/18123), with each wire format
+(including the dictionary/prefix-encoded variant) and compression option, and reports latency and MB/s. The fastest combination is
+written to the file migrate_data.py reads at startup (clickhouse_transport.json).
+Probe mode imports migrate_data, so it needs the migrator's dependencies.
+
 This is intentionally dependency-light and prints clear success/error messages.
 """
 
@@ -21,9 +29,20 @@ import subprocess
 import sys
 import os
 import json
+import time
+import argparse
+from datetime import datetime
 
 DEFAULT_TIMEOUT = 5
 
+PROBE_TABLE = 'images_analytical_probe'
+PROBE_SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mysql_rows_1_1001_NULLs.json')
+PROBE_ROUNDS = 3
+PROBE_COMPRESSION = {
+    'native': ('none', 'lz4'),
+    'http': ('none', 'gzip'),
+}
+
 
 def load_config():
     conf = {}
@@ -130,7 +149,150 @@ def test_clickhouse_client(host, port, username=None, password=None, database=No
     return False
 
 
+def load_probe_rows(n_rows, path=PROBE_SAMPLE):
+    """Return up to n_rows transformed rows from the fixture.
+
+    Rows are not repeated to reach n_rows: repeated rows compress and dictionary-encode
+    far better than production chunks and would skew the probe's choice.
+    """
+    from migrate_data import transform_row
+
+    with open(path) as f:
+        mysql_rows = json.load(f)
+    return [transform_row(r, None, None) for r in mysql_rows[:n_rows]]
+
+
+def sample_probe_rows(run_admin, source_table, n_rows):
+    """Return up to n_rows real rows from source_table (as insert_batch would send them), or [] if none."""
+    from migrate_data import INSERT_COLUMNS
+
+    ok, out, _ = run_admin(
+        f"SELECT {', '.join(INSERT_COLUMNS)} FROM {source_table} LIMIT {int(n_rows)} "
+        f"SETTINGS output_format_json_quote_64bit_integers = 0 FORMAT JSONEachRow"
+    )
+    if not ok:
+        print(f"  Could not sample {source_table}: {out.strip()[:200]}")
+        return []
+    return [json.loads(line) for line in out.splitlines() if line.strip()]
+
+
+def probe_transports(conf, n_rows, out_path):
+    """Time sample inserts over every transport/format/compression and save the winner."""
+    from migrate_data import INSERT_FORMATS, encode_insert, run_client_query, run_http_query
+
+    port = conf.get('port', 8123)
+    database = conf.get('database')
+    source_table = f"{database}.images_analytical" if database else 'images_analytical'
+    probe_table = f"{database}.{PROBE_TABLE}" if database else PROBE_TABLE
+
+    candidates = []
+    for p in [9000] + ([port] if port not in (9000, 8123, 18123) else []):
+        candidates.append(('native', p))
+    for p in ([port] if port in (8123, 18123) else []) + [18123, 8123]:
+        if ('http', p) not in candidates:
+            candidates.append(('http', p))
+
+    def run(transport, p, query, payload=None, compression=None):
+        if transport == 'native':
+            return run_client_query(p, query, payload, compression=compression, conf=conf)
+        return run_http_query(p, query, payload, compression=compression, conf=conf)
+
+    print(f"\nProbing insert throughput into {probe_table}...")
+
+    reachable = []
+    for transport, p in candidates:
+        ok, out, _ = run(transport, p, 'SELECT 1')
+        print(f"  {transport}:{p} {'reachable' if ok else 'unavailable: ' + out.strip()[:120]}")
+        if ok:
+            reachable.append((transport, p))
+    if not reachable:
+        print("  ✗ No transport reachable; nothing to probe")
+        return None
+
+    admin = reachable[0]
+    ok, out, _ = run(*admin, f"CREATE TABLE IF NOT EXISTS {probe_table} AS {source_table}")
+    if not ok:
+        print(f"  ✗ Could not create scratch table {probe_table}: {out.strip()}")
+        return None
+
+    rows = sample_probe_rows(lambda query: run(*admin, query), source_table, n_rows)
+    if rows:
+        print(f"  Sampled {len(rows)} rows from {source_table}")
+    else:
+        rows = load_probe_rows(n_rows)
+        print(f"  {source_table} is empty; using {len(rows)} fixture rows from {os.path.basename(PROBE_SAMPLE)}")
+    n_rows = len(rows)
+
+    # Column types of the scratch table, needed for the dictionary-encoded variant
+    ok, out, _ = run(*admin, f"DESCRIBE TABLE {probe_table} FORMAT TabSeparated")
+    types = {line.split('\t')[0]: line.split('\t')[1] for line in out.splitlines() if '\t' in line} if ok else None
+    # (format, dictionary): dictionary encoding always travels as JSONCompactEachRow
+    encodings = [(fmt, False) for fmt in INSERT_FORMATS] + ([('JSONCompactEachRow', True)] if types else [])
+
+    results = []
+    try:
+        for transport, p in reachable:
+            for fmt, dictionary in encodings:
+                label = fmt + ('+dict' if dictionary else '')
+                for compression in PROBE_COMPRESSION[transport]:
+                    timings = []
+                    for _ in range(PROBE_ROUNDS):
+                        run(*admin, f"TRUNCATE TABLE {probe_table}")
+                        started = time.perf_counter()
+                        # Encoding is part of the cost the migrator pays per chunk
+                        query, payload = encode_insert(probe_table, rows, fmt, dictionary=dictionary, types=types)
+                        ok, out, _ = run(transport, p, query, payload, compression)
+                        elapsed = time.perf_counter() - started
+                        if not ok:
+                            print(f"  ✗ {transport}:{p} {label} {compression}: {out.strip()[:200]}")
+                            break
+                        timings.append(elapsed)
+                    if len(timings) < PROBE_ROUNDS:
+                        continue
+                    latency = sorted(timings)[len(timings) // 2]
+                    # Uncompressed bytes on the wire; dictionaries travel in the query text
+                    mb = (len(payload.encode()) + (len(query.encode()) if dictionary else 0)) / 1e6
+                    results.append({
+                        'transport': transport,
+                        'port': p,
+                        'format': fmt,
+                        'compression': compression,
+                        'dictionary': dictionary,
+                        'latency_s': round(latency, 4),
+                        'payload_mb': round(mb, 3),
+                        'mb_per_s': round(mb / latency, 2),
+                        'rows_per_s': round(n_rows / latency),
+                    })
+                    print(f"  ✓ {transport}:{p:<5} {label:<23} {compression:<4}  "
+                          f"{latency:7.3f}s  {mb:7.2f} MB  {mb / latency:7.2f} MB/s  {n_rows / latency:9.0f} rows/s")
+    finally:
+        run(*admin, f"DROP TABLE IF EXISTS {probe_table}")
+
+    if not results:
+        print("  ✗ Every probe insert failed; not writing a transport config")
+        return None
+
+    best = min(results, key=lambda r: r['latency_s'])
+    config = dict(best)
+    config['host'] = conf.get('host')
+    config['probe_rows'] = n_rows
+    config['probed_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with open(out_path, 'w') as f:
+        json.dump(config, f, indent=2)
+    print(f"\nFastest: {best['transport']}:{best['port']} {best['format']} compression={best['compression']} "
+          f"dictionary={best['dictionary']} "
+          f"({best['mb_per_s']} MB/s)")
+    print(f"Wrote {out_path}; migrate_data.py will try this transport first")
+    return config
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Test ClickHouse connectivity and optionally probe insert throughput')
+    parser.add_argument('--probe', action='store_true', help='Measure insert latency/MB/s per transport, format and compression and save the fastest')
+    parser.add_argument('--probe-rows', type=int, default=10000, help='Rows per probe insert (default matches INSERT_CHUNK_SIZE)')
+    parser.add_argument('--probe-out', default=None, help='Where to write the winning config (default: migrate_data.TRANSPORT_CONFIG_FILE)')
+    args = parser.parse_args()
+
     conf = load_config()
     print("Using ClickHouse config:")
     print(json.dumps(conf, indent=2, default=str))
@@ -161,6 +323,14 @@ def main():
 
     print('\nAt least one connection method succeeded.')
 
+    if args.probe:
+        out_path = args.probe_out
+        if out_path is None:
+            from migrate_data import TRANSPORT_CONFIG_FILE
+            out_path = TRANSPORT_CONFIG_FILE
+        if probe_transports(conf, args.probe_rows, out_path) is None:
+            sys.exit(3)
+
 
 if __name__ == '__main__':
     main()